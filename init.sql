@@ -1,3 +1,8 @@
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+DROP TABLE IF EXISTS run_ledger CASCADE;
+DROP TABLE IF EXISTS pipeline_state CASCADE;
+DROP TABLE IF EXISTS ingest_changes CASCADE;
 DROP TABLE IF EXISTS unmatched_report CASCADE;
 DROP TABLE IF EXISTS match_results CASCADE;
 DROP TABLE IF EXISTS transactions_parsed CASCADE;
@@ -24,7 +29,10 @@ CREATE TABLE addresses (
   zip TEXT,
   latitude DOUBLE PRECISION,
   longitude DOUBLE PRECISION,
-  homeownercd TEXT
+  homeownercd TEXT,
+  street_metaphone TEXT,
+  street_metaphone_alt TEXT,
+  content_hash TEXT
 );
 
 CREATE TABLE transactions_raw (
@@ -59,7 +67,8 @@ CREATE TABLE transactions_raw (
   presented_by_last_name TEXT,
   presented_by_middle_name TEXT,
   presented_by_suffix TEXT,
-  geog TEXT
+  geog TEXT,
+  content_hash TEXT
 );
 
 CREATE TABLE transactions_parsed (
@@ -82,13 +91,40 @@ CREATE TABLE match_results (
   address_id INTEGER REFERENCES addresses(id),
   match_type TEXT,
   confidence_score FLOAT,
-  matched_at TEXT
+  matched_at TEXT,
+  run_id TEXT
 );
 
 CREATE TABLE unmatched_report (
   transaction_id TEXT REFERENCES transactions_raw(id),
   reason TEXT,
-  attempted_at TEXT
+  attempted_at TEXT,
+  run_id TEXT
+);
+
+CREATE TABLE ingest_changes (
+  id SERIAL PRIMARY KEY,
+  table_name TEXT,
+  record_id TEXT,
+  change_type TEXT,
+  changed_at TEXT
+);
+
+CREATE TABLE pipeline_state (
+  key TEXT PRIMARY KEY,
+  value TEXT
+);
+
+CREATE TABLE run_ledger (
+  run_id TEXT,
+  stage TEXT,
+  status TEXT,
+  last_key TEXT,
+  rows_in BIGINT,
+  rows_out BIGINT,
+  started_at TEXT,
+  updated_at TEXT,
+  PRIMARY KEY (run_id, stage)
 );
 
 CREATE INDEX idx_transactions_parsed_address ON transactions_parsed (
@@ -99,4 +135,15 @@ CREATE INDEX idx_addresses_address ON addresses (
   house, street, strtype, predir, postdir, apttype, aptnbr, city, state, zip
 );
 
+CREATE INDEX idx_addresses_street_trgm ON addresses
+  USING gin ((btrim(coalesce(street, '') || ' ' || coalesce(strtype, ''))) gin_trgm_ops);
+
+CREATE INDEX idx_addresses_phonetic ON addresses (house, street_metaphone);
+CREATE INDEX idx_addresses_phonetic_alt ON addresses (house, street_metaphone_alt);
+
 CREATE INDEX idx_match_transaction_id ON match_results(transaction_id);
+CREATE INDEX idx_match_address_id ON match_results(address_id);
+CREATE INDEX idx_match_run_id ON match_results(run_id);
+CREATE INDEX idx_unmatched_run_id ON unmatched_report(run_id);
+CREATE INDEX idx_unmatched_transaction_id ON unmatched_report(transaction_id);
+CREATE INDEX idx_ingest_changes_table ON ingest_changes(table_name, id);
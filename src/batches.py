@@ -0,0 +1,118 @@
+from config import config
+from metrics import metrics
+import logging
+import queue
+import threading
+import time
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+logger = logging.getLogger(__name__)
+
+# marks the end of a queue
+DONE = object()
+# how often a blocked put or get checks whether another thread failed
+POLL_SECONDS = 0.1
+
+def put(q, item, stop):
+    """Put item, waiting while q is full. Returns False if stop was set first."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=POLL_SECONDS)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def get(q, stop):
+    """Next item of q, or DONE once stop is set and nothing is left."""
+    while True:
+        try:
+            return q.get(timeout=POLL_SECONDS)
+        except queue.Empty:
+            if stop.is_set():
+                return DONE
+
+def run_batches(
+    batches,
+    compute,
+    write,
+    stage,
+    pipelined=config.pipeline.execution == "pipelined",
+    depth=config.pipeline.queue_depth,
+):
+    """Feed every batch through compute and hand each result to write.
+
+    Sequentially, one batch is fetched, computed and written before the next
+    is fetched. Pipelined, a reader thread iterates batches and a writer
+    thread calls write, while compute runs in the calling thread. Queues of
+    at most depth items sit in between, so a slow stage holds the others
+    back instead of letting batches pile up in memory. An exception in any
+    thread stops the other two and is raised here.
+
+    batches must not depend on the results being written, e.g. it pages by
+    keyset. write is only ever called from one thread. The time between two
+    computed batches is recorded as batch_seconds of stage.
+    """
+    if not pipelined:
+        last = time.perf_counter()
+        for batch in batches:
+            write(compute(batch))
+            now = time.perf_counter()
+            metrics.observe_time("batch_seconds", now - last, stage=stage)
+            last = now
+        return
+
+    fetched = queue.Queue(maxsize=depth)
+    computed = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    errors = []
+
+    def read():
+        try:
+            for batch in batches:
+                if not put(fetched, batch, stop):
+                    return
+            put(fetched, DONE, stop)
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    def drain():
+        try:
+            while not stop.is_set():
+                result = get(computed, stop)
+                if result is DONE:
+                    return
+                write(result)
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    reader = threading.Thread(target=read, name=f"{stage}-reader", daemon=True)
+    writer = threading.Thread(target=drain, name=f"{stage}-writer", daemon=True)
+    reader.start()
+    writer.start()
+    try:
+        last = time.perf_counter()
+        while True:
+            with metrics.timer("queue_wait_seconds", stage=stage, side="fetch"):
+                batch = get(fetched, stop)
+            if batch is DONE:
+                break
+            result = compute(batch)
+            with metrics.timer("queue_wait_seconds", stage=stage, side="write"):
+                if not put(computed, result, stop):
+                    break
+            now = time.perf_counter()
+            metrics.observe_time("batch_seconds", now - last, stage=stage)
+            last = now
+        put(computed, DONE, stop)
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        writer.join()
+        # a reader blocked on a full queue gives up once stop is set
+        reader.join()
+    if errors:
+        raise errors[0]
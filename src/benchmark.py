@@ -0,0 +1,187 @@
+from config import config
+from contextlib import contextmanager
+from datetime import datetime
+from db import migrate, new_run_id
+from file_pipeline import run_file_pipeline
+from metrics import metrics
+from synthetic import write_dataset
+import argparse
+import json
+import logging
+import os
+import pandas as pd
+import resource
+import subprocess
+import time
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+logger = logging.getLogger(__name__)
+
+def peak_rss_mb():
+    """Peak resident set size so far of this process and its finished children, in MB (Linux reports KB)."""
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) / 1024
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+class StageTimer:
+    """Collects wall time, row counts and peak RSS per benchmark stage."""
+
+    def __init__(self):
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name, rows=0):
+        """Time the block. The yielded record's "rows" can be set inside it when the count is only known there."""
+        record = {"stage": name, "rows": rows}
+        start = time.perf_counter()
+        yield record
+        seconds = time.perf_counter() - start
+        record["seconds"] = round(seconds, 4)
+        record["rows_per_sec"] = round(record["rows"] / seconds, 1) if seconds > 0 else None
+        record["peak_rss_mb"] = round(peak_rss_mb(), 1)
+        self.stages.append(record)
+        logger.info(f"[BENCHMARK] {name}: {record['rows']} rows in {seconds:.2f}s")
+
+def metric_stages():
+    """Benchmark records of the batched stages and of each matcher, from the timers the pipeline recorded.
+
+    Rows are the rows each stage or matcher was given, over every batch; with
+    the match memo, the matchers only see one transaction per distinct key.
+    """
+    counters, timers, _ = metrics.state()
+    stages = []
+    for (name, labels), (batches, seconds, _) in sorted(timers.items()):
+        labels = dict(labels)
+        if name == "stage_seconds":
+            stage = labels["stage"]
+            rows = counters.get(("rows_in_total", (("stage", stage),)), 0)
+        elif name == "matcher_seconds":
+            stage = f"{labels['matcher']}_match"
+            rows = counters.get(("matcher_rows_in_total", (("matcher", labels["matcher"]),)), 0)
+        elif name == "phase_seconds" and labels["phase"] == "write":
+            stage = f"{labels['stage']}_write"
+            rows = counters.get(("rows_out_total", (("stage", "match" if labels["stage"] == "files" else labels["stage"]),)), 0)
+        else:
+            continue
+        stages.append({
+            "stage": stage,
+            "rows": rows,
+            "batches": batches,
+            "seconds": round(seconds, 4),
+            "rows_per_sec": round(rows / seconds, 1) if seconds > 0 else None,
+        })
+    return stages
+
+def run_files(timer, out_dir, addresses_path, transactions_path, run_id, workers, chunk_size):
+    """The file pipeline end to end: streamed chunks, parse_batch, the memoized waterfall and CsvAppender output."""
+    with timer.stage("pipeline", rows=0) as record:
+        run_file_pipeline(
+            transactions_path, addresses_path, output_dir=out_dir, run_id=run_id, workers=workers, chunk_size=chunk_size,
+            cache_path=None,
+        )
+        record["rows"] = metrics.counters.get(("rows_in_total", (("stage", "parse"),)), 0)
+    return os.path.join(out_dir, config.output.matches_csv)
+
+def run_database(timer, addresses_path, transactions_path, run_id, workers):
+    """Every database stage as main runs it, then the export_csv exporter."""
+    from export_csv import export_final_matches, export_unmatched_report
+    from ingest import ingest_address, ingest_transactions
+    from match import run_match
+    from parse import normalize_and_parse
+
+    migrate()
+    with timer.stage("load_data") as record:
+        record["rows"] = ingest_address(addresses_path, mode="full") + ingest_transactions(transactions_path, mode="full")
+    with timer.stage("normalize_and_parse", rows=record["rows"]), metrics.timer("stage_seconds", stage="parse"):
+        normalize_and_parse(workers=workers, run_id=run_id, cache_path=None)
+    with timer.stage("match") as record, metrics.timer("stage_seconds", stage="match"):
+        run_match(mode="full", run_id=run_id)
+        record["rows"] = metrics.counters.get(("rows_in_total", (("stage", "match"),)), 0)
+    with timer.stage("export") as record:
+        matches_path = export_final_matches(fmt="csv", compress=False, run_id=run_id)
+        export_unmatched_report(fmt="csv", compress=False, run_id=run_id)
+    return matches_path
+
+def run_benchmark(
+    out_dir, n_addresses, n_transactions, use_db=False, workers=config.pipeline.parse_workers,
+    chunk_size=config.ingest.chunk_size, **noise,
+):
+    """Generate a dataset, run the pipeline over it once and return the result record.
+
+    The stages are the ones a real run goes through, batch by batch, ending
+    with the real exporter. Per-stage and per-matcher times come from the
+    pipeline's own metrics. The parse cache is kept in memory only, so a
+    repeat run over the same seeded dataset parses again rather than reading
+    the previous run's entries from the cache file.
+    """
+    timer = StageTimer()
+    with timer.stage("generate", rows=n_addresses + n_transactions):
+        addresses_path, transactions_path = write_dataset(out_dir, n_addresses, n_transactions, **noise)
+
+    metrics.reset()
+    run_id = new_run_id()
+    if use_db:
+        matches_path = run_database(timer, addresses_path, transactions_path, run_id, workers)
+    else:
+        matches_path = run_files(timer, out_dir, addresses_path, transactions_path, run_id, workers, chunk_size)
+
+    match_types = pd.read_csv(matches_path, usecols=["transaction_id", "match_type"])
+    failures = sum(value for (name, _), value in metrics.counters.items() if name == "parse_failures_total")
+    return {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(),
+        "params": {
+            "addresses": n_addresses,
+            "transactions": n_transactions,
+            "use_db": use_db,
+            "parse_workers": workers,
+            "batch_size": config.pipeline.batch_size if use_db else chunk_size,
+            **noise,
+        },
+        "summary": {
+            "parse_failures": failures,
+            **match_types.match_type.value_counts().to_dict(),
+            "matched_transactions": match_types.transaction_id.nunique(),
+        },
+        "stages": timer.stages + metric_stages(),
+    }
+
+def write_result(result, results_dir=config.benchmark.results_dir):
+    os.makedirs(results_dir, exist_ok=True)
+    name = f"{datetime.now().strftime('%Y%m%dT%H%M%S')}-{result['commit'] or 'nocommit'}-{result['params']['transactions']}.json"
+    path = os.path.join(results_dir, name)
+    with open(path, "w") as f:
+        json.dump(result, f, indent=2)
+    logger.info(f"Wrote benchmark results to {path}")
+    return path
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time each pipeline stage on synthetic data.")
+    parser.add_argument("--addresses", type=int, default=10_000)
+    parser.add_argument("--transactions", type=int, default=10_000)
+    parser.add_argument("--duplicate-rate", type=float, default=0.3)
+    parser.add_argument("--typo-rate", type=float, default=0.05)
+    parser.add_argument("--unit-noise-rate", type=float, default=0.05)
+    parser.add_argument("--unparseable-rate", type=float, default=0.02)
+    parser.add_argument("--house-typo-rate", type=float, default=0.0)
+    parser.add_argument("--workers", type=int, default=config.pipeline.parse_workers)
+    parser.add_argument("--chunk-size", type=int, default=config.ingest.chunk_size, help="transactions per file pipeline batch")
+    parser.add_argument("--db", action="store_true", help="run the database stages and the export_csv exporter against PostgreSQL instead of the file pipeline")
+    parser.add_argument("--data-dir", default=config.benchmark.data_dir)
+    args = parser.parse_args()
+    result = run_benchmark(
+        args.data_dir, args.addresses, args.transactions, use_db=args.db, workers=args.workers, chunk_size=args.chunk_size,
+        duplicate_rate=args.duplicate_rate, typo_rate=args.typo_rate,
+        unit_noise_rate=args.unit_noise_rate, unparseable_rate=args.unparseable_rate,
+        house_typo_rate=args.house_typo_rate,
+    )
+    write_result(result)
@@ -1,5 +1,44 @@
 from config import config
-from sqlalchemy import create_engine
+from datetime import datetime
+from functools import lru_cache
+from schema import MIGRATIONS
+from sqlalchemy import create_engine, text
+import io
+import uuid
 
+@lru_cache(maxsize=None)
 def get_connection():
+    """Process-wide engine shared by every stage."""
     return create_engine(config.db.url)
+
+def migrate(engine=None):
+    """Apply the schema MIGRATIONS, so a database created from an older init.sql gains the new columns and tables."""
+    engine = engine if engine is not None else get_connection()
+    with engine.begin() as conn:
+        for statement in MIGRATIONS:
+            conn.execute(text(statement))
+
+def copy_dataframe(cursor, table_name, df):
+    """Stream a DataFrame into table_name with COPY FROM STDIN. Nulls are sent as empty unquoted fields."""
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    columns = ", ".join(df.columns)
+    cursor.copy_expert(f"COPY {table_name} ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+def get_state(conn, key):
+    """Read a value from pipeline_state, or None if it was never set."""
+    return conn.execute(text("SELECT value FROM pipeline_state WHERE key = :key"), {"key": key}).scalar()
+
+def set_state(conn, key, value):
+    conn.execute(
+        text(
+            "INSERT INTO pipeline_state (key, value) VALUES (:key, :value) "
+            "ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value"
+        ),
+        {"key": key, "value": str(value)},
+    )
+
+def new_run_id():
+    """Sortable, unique id stamped on the result rows written by one pipeline run."""
+    return f"{datetime.now().strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
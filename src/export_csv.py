@@ -1,8 +1,15 @@
 from config import config
-from db import get_connection
+from db import get_connection, migrate
+from schema import match_results, unmatched_report
+from sqlalchemy import select
+import argparse
+import gzip
 import logging
 import os
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import sqlalchemy
 
 
 logging.basicConfig(level=logging.DEBUG, format="%(asctime)s [%(levelname)s] %(message)s")
@@ -10,18 +17,93 @@ logger = logging.getLogger(__name__)
 
 engine = get_connection()
 
-def export_final_matches():
-    df = pd.read_sql_table("match_results", engine)
-    output_path = os.path.join(config.output.dir, config.output.matches_csv)
-    df.to_csv(output_path, index=False)
+# column holding each table's timestamp, used for time-window exports
+TIME_COLUMNS = {
+    match_results.name: match_results.c.matched_at,
+    unmatched_report.name: unmatched_report.c.attempted_at,
+}
+
+def export_query(table, run_id=None, since=None, until=None):
+    """Rows of table, optionally limited to one run and/or a [since, until) window of ISO timestamps."""
+    statement = select(table)
+    if "id" in table.c:
+        statement = statement.order_by(table.c.id)
+    if run_id is not None:
+        statement = statement.where(table.c.run_id == run_id)
+    if since is not None:
+        statement = statement.where(TIME_COLUMNS[table.name] >= since)
+    if until is not None:
+        statement = statement.where(TIME_COLUMNS[table.name] < until)
+    return statement
+
+def output_path(filename, fmt, compress):
+    path = os.path.join(config.output.dir, filename)
+    if fmt == "parquet":
+        path = os.path.splitext(path)[0] + ".parquet"
+    elif compress:
+        path += ".gz"
+    return path
+
+def copy_to_csv(statement, path, compress):
+    """Stream the query result to a CSV file with COPY ... TO STDOUT."""
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            compiled = statement.compile(dialect=engine.dialect)
+            query = cursor.mogrify(compiled.string, compiled.params).decode("utf-8")
+            opener = gzip.open if compress else open
+            with opener(path, "wt", newline="") as f:
+                cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER true)", f)
+    finally:
+        conn.close()
+
+def arrow_schema(table):
+    types = {sqlalchemy.Integer: pa.int64(), sqlalchemy.Float: pa.float64()}
+    fields = []
+    for column in table.columns:
+        arrow_type = next((t for sql_type, t in types.items() if isinstance(column.type, sql_type)), pa.string())
+        fields.append(pa.field(column.name, arrow_type))
+    return pa.schema(fields)
+
+def stream_to_parquet(table, statement, path, chunk_size=config.output.chunk_size):
+    """Write the query result to Parquet one row group per chunk, read through a server-side cursor."""
+    schema = arrow_schema(table)
+    total = 0
+    with engine.connect().execution_options(stream_results=True, max_row_buffer=chunk_size) as conn:
+        with pq.ParquetWriter(path, schema) as writer:
+            for chunk in pd.read_sql(statement, conn, chunksize=chunk_size):
+                writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+                total += len(chunk)
+    return total
+
+def export_table(table, filename, fmt=config.output.format, compress=config.output.compress, run_id=None, since=None, until=None):
+    path = output_path(filename, fmt, compress)
+    statement = export_query(table, run_id, since, until)
+    if fmt == "parquet":
+        stream_to_parquet(table, statement, path)
+    else:
+        copy_to_csv(statement, path, compress)
+    return path
+
+def export_final_matches(**kwargs):
+    output_path = export_table(match_results, config.output.matches_csv, **kwargs)
     logger.info(f"Exported final match results to {output_path}")
+    return output_path
 
-def export_unmatched_report():
-    df = pd.read_sql_table("unmatched_report", engine)
-    output_path = os.path.join(config.output.dir, config.output.unmatched_csv)
-    df.to_csv(output_path, index=False)
+def export_unmatched_report(**kwargs):
+    output_path = export_table(unmatched_report, config.output.unmatched_csv, **kwargs)
     logger.info(f"Exported unmatched report to {output_path}")
+    return output_path
 
 if __name__ == "__main__":
-    export_final_matches()
-    export_unmatched_report()
+    parser = argparse.ArgumentParser(description="Export match results and the unmatched report.")
+    parser.add_argument("--format", choices=["csv", "parquet"], default=config.output.format)
+    parser.add_argument("--gzip", action="store_true", default=config.output.compress, help="gzip CSV output")
+    parser.add_argument("--run-id", help="only export rows written by this run")
+    parser.add_argument("--since", help="only export rows at or after this ISO timestamp")
+    parser.add_argument("--until", help="only export rows before this ISO timestamp")
+    args = parser.parse_args()
+    migrate()
+    options = dict(fmt=args.format, compress=args.gzip, run_id=args.run_id, since=args.since, until=args.until)
+    export_final_matches(**options)
+    export_unmatched_report(**options)
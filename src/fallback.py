@@ -1,8 +1,8 @@
 from config import config
 from db import get_connection
 from datetime import datetime
-from metaphone import doublemetaphone
-from schema import transactions_parsed, addresses
+from metrics import metrics
+from normalize import phonetic_keys
 import logging
 import pandas as pd
 import re
@@ -12,6 +12,8 @@ logger = logging.getLogger(__name__)
 
 engine = get_connection()
 
+PHONETIC_CONFIDENCE = 0.6  # heuristic
+
 def match_unit_identifier(tx_unit, addr_unit):
     if pd.isna(tx_unit) or pd.isna(addr_unit):
         return False
@@ -19,36 +21,46 @@ def match_unit_identifier(tx_unit, addr_unit):
     norm_addr = re.sub(r"[^\w]", "", str(addr_unit)).upper()
     return norm_tx == norm_addr
 
-def phonetic_fallback(txn_df, addr_df):
+def phonetic_address_ids(street_number, street_codes, unit_identifier, ref):
+    """Address ids sharing the house number and any metaphone code of the street, in reference order."""
+    address_ids = []
+    positions = ref.phonetic_positions(street_number, street_codes)
+    if len(positions):
+        metrics.observe("candidate_block_size", len(positions), matcher="phonetic")
+    else:
+        metrics.inc("candidate_block_misses_total", matcher="phonetic")
+    for position in positions:
+        addr_unit = ref.units[position]
+        if pd.notna(unit_identifier) and pd.notna(addr_unit):
+            if not match_unit_identifier(unit_identifier, addr_unit):
+                metrics.inc("unit_mismatches_total", matcher="phonetic")
+        address_ids.append(ref.ids[position])
+        if config.pipeline.take_first_phonetic_match:
+            break
+    return address_ids
+
+def phonetic_fallback(txn_df, ref):
+    """Join transactions to the reference on (house, metaphone code), using both metaphone codes."""
     results = []
-    for _, txn in txn_df.iterrows():
-        # compute the phonetic code for the street name
-        txn_code = doublemetaphone(txn.street_name)[0]
-        # blocking on zip code
-        candidates = addr_df[(addr_df.house == txn.street_number)]
-
-        for _, addr in candidates.iterrows():
-            addr_code = doublemetaphone(addr.street)[0]
-            if txn_code == addr_code:
-                if txn.unit_identifier and addr.aptnbr:
-                    if not match_unit_identifier(txn.unit_identifier, addr.aptnbr):
-                        logger.debug(f"Unit mismatch: TXN={txn.unit_identifier} vs ADDR={addr.aptnbr}")
-                logger.debug(f"Phonetic match found: {txn.street_name} -> {addr.street}")
-                results.append({
-                    "transaction_id": txn.id,
-                    "address_id": addr.id,
-                    "match_type": "phonetic",
-                    "confidence_score": 0.6,  # heuristic
-                    "matched_at": datetime.now().isoformat()
-                })
-                if config.pipeline.take_first_phonetic_match:
-                    break
+    matched_at = datetime.now().isoformat()
+    # encode each distinct street once per batch
+    codes = {street: phonetic_keys(street) for street in txn_df.street_name.dropna().unique()}
+    for txn in txn_df.itertuples(index=False):
+        txn_codes = [code for code in codes.get(txn.street_name, ()) if code]
+        for address_id in phonetic_address_ids(txn.street_number, txn_codes, txn.unit_identifier, ref):
+            results.append({
+                "transaction_id": txn.id,
+                "address_id": address_id,
+                "match_type": "phonetic",
+                "confidence_score": PHONETIC_CONFIDENCE,
+                "matched_at": matched_at
+            })
     return pd.DataFrame(results)
 
-def run_fallbacks(unmatched_df, addr_df):
+def run_fallbacks(unmatched_df, ref):
     logger.info(f"[FALLBACK] Starting fallback with {len(unmatched_df)} unmatched transactions")
 
-    phonetic_df = phonetic_fallback(unmatched_df, addr_df)
+    phonetic_df = phonetic_fallback(unmatched_df, ref)
     logger.info(f"[FALLBACK] Phonetic matches: {len(phonetic_df)}")
 
     return phonetic_df
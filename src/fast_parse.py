@@ -0,0 +1,102 @@
+from normalize import DIRECTIONAL_ABBR, STREET_TYPE_ABBR, USPS_SECONDARY_UNITS
+import argparse
+import logging
+import pandas as pd
+import re
+import time
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+logger = logging.getLogger(__name__)
+
+def alternation(words):
+    # longest first, so that e.g. NORTHEAST is not read as NORTH
+    return "|".join(re.escape(word) for word in sorted(words, key=len, reverse=True))
+
+# Only the spelled-out words that normalize_tagged_address can map are accepted; anything else goes to usaddress.
+DIRECTION = alternation(DIRECTIONAL_ABBR)
+STREET_TYPE = alternation(STREET_TYPE_ABBR)
+UNIT_TYPE = alternation(USPS_SECONDARY_UNITS)
+WORD = r"[A-Z0-9][A-Z0-9'.-]*"
+
+# "<number> [predir] <name> <type> [postdir][[,] <unit type> <unit id>], <city> <state> <zip>", as assembled by parse.assemble_address
+ADDRESS_PATTERN = re.compile(
+    rf"^(?P<AddressNumber>\d+)"
+    rf"\s+(?:(?P<StreetNamePreDirectional>{DIRECTION})\s+)?"
+    rf"(?P<StreetName>{WORD}(?:\s+{WORD})*?)"
+    rf"\s+(?P<StreetNamePostType>{STREET_TYPE})"
+    rf"(?:\s+(?P<StreetNamePostDirectional>{DIRECTION}))?"
+    rf"(?:(?:,\s*|\s+)(?P<OccupancyType>{UNIT_TYPE})\s+(?P<OccupancyIdentifier>[A-Z0-9][A-Z0-9-]*))?"
+    rf",\s*(?P<PlaceName>[A-Z][A-Z'.-]*(?:\s+[A-Z][A-Z'.-]*)*?)"
+    rf"\s+(?P<StateName>[A-Z]{{2}})"
+    rf"\s+(?P<ZipCode>\d{{5}})$",
+    re.IGNORECASE,
+)
+
+def fast_tag(address):
+    """usaddress-style tags of an address in one of the regular shapes, or None to fall back to usaddress.
+
+    A street name made only of directionals or unit words is left to
+    usaddress, since the split is ambiguous there.
+    """
+    match = ADDRESS_PATTERN.match(address.strip())
+    if match is None:
+        return None
+    tagged = {label: value for label, value in match.groupdict().items() if value is not None}
+    name_words = tagged["StreetName"].upper().split()
+    if all(word in DIRECTIONAL_ABBR or word in USPS_SECONDARY_UNITS for word in name_words):
+        return None
+    return tagged
+
+def compare_with_usaddress(addresses):
+    """Hit rate, timings and disagreements of fast_tag against usaddress over the distinct addresses."""
+    from parse import parse_address, PARSE_ERRORS
+
+    def outcome(address, fast):
+        try:
+            return parse_address(address, fast=fast)
+        except PARSE_ERRORS as e:
+            return type(e).__name__
+
+    addresses = list(dict.fromkeys(addresses))
+    start = time.perf_counter()
+    fast = {address: fast_tag(address) for address in addresses}
+    fast_seconds = time.perf_counter() - start
+    hits = [address for address, tagged in fast.items() if tagged is not None]
+
+    start = time.perf_counter()
+    reference = {address: outcome(address, fast=False) for address in hits}
+    usaddress_seconds = time.perf_counter() - start
+    mismatches = []
+    for address, expected in reference.items():
+        got = outcome(address, fast=True)
+        if got != expected:
+            mismatches.append((address, got, expected))
+    return {
+        "addresses": len(addresses),
+        "hits": len(hits),
+        "hit_rate": len(hits) / len(addresses) if addresses else 0.0,
+        "fast_us_per_address": fast_seconds / len(addresses) * 1e6 if addresses else 0.0,
+        "usaddress_us_per_address": usaddress_seconds / len(hits) * 1e6 if hits else 0.0,
+        "mismatches": mismatches,
+    }
+
+if __name__ == "__main__":
+    from parse import assemble_address
+
+    parser = argparse.ArgumentParser(description="Check the fast-path parser against usaddress on a sample of a transactions CSV.")
+    parser.add_argument("csv_path")
+    parser.add_argument("--sample", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    df = pd.read_csv(args.csv_path, dtype=str)
+    df = df.sample(n=min(args.sample, len(df)), random_state=args.seed)
+    addresses = list(dict.fromkeys(assemble_address(row) for row in df.to_dict("records")))
+    report = compare_with_usaddress(addresses)
+    logger.info(
+        f"Fast path parsed {report['hits']} of {report['addresses']} distinct addresses ({report['hit_rate']:.1%}); "
+        f"{report['fast_us_per_address']:.1f} us per address against {report['usaddress_us_per_address']:.1f} us with usaddress"
+    )
+    for address, fast, expected in report["mismatches"][:20]:
+        logger.warning(f"Mismatch for {address}:\n  fast:      {fast}\n  usaddress: {expected}")
+    logger.info(f"{len(report['mismatches'])} mismatches")
@@ -0,0 +1,132 @@
+from config import config
+from db import new_run_id
+from export_csv import arrow_schema
+from ingest import conform_chunk, prepare_addresses, read_csv_chunks
+from match import KeyMemo, match_transactions
+from metrics import metrics
+from parse import make_parse_pool, parse_batch, parse_workers, record_parse_metrics
+from parse_cache import ParseCache
+from reference import ReferenceIndex, COORDINATE_COLUMNS
+from schema import addresses, transactions_raw, transactions_parsed, match_results, unmatched_report
+import logging
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import time
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+logger = logging.getLogger(__name__)
+
+def read_table_chunks(path, table, prepare=None, chunk_size=config.ingest.chunk_size):
+    """Yield a CSV or Parquet file in chunks shaped like the table, with text columns as str as in ingest."""
+    if path.endswith(".parquet"):
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            chunk = batch.to_pandas()
+            chunk = chunk.astype(object).where(chunk.isna(), chunk.astype(str))
+            if prepare is not None:
+                chunk = prepare(chunk)
+            yield conform_chunk(chunk, table)
+    else:
+        yield from read_csv_chunks(path, table, prepare, chunk_size, fingerprint=False)
+
+def load_reference(path=config.paths.addresses):
+    """The whole addresses file as a ReferenceIndex. Only the transactions are streamed."""
+    return ReferenceIndex(pd.concat(read_table_chunks(path, addresses, prepare_addresses), ignore_index=True))
+
+class CsvAppender:
+    """Appends DataFrames to one CSV, writing the header with the first chunk."""
+
+    def __init__(self, path, columns):
+        self.path = path
+        self.columns = columns
+        self.rows = 0
+        pd.DataFrame(columns=columns).to_csv(path, index=False)
+
+    def append(self, df):
+        if df.empty:
+            return
+        df.reindex(columns=self.columns).to_csv(self.path, mode="a", header=False, index=False)
+        self.rows += len(df)
+
+def run_file_pipeline(
+    transactions_path=config.paths.transactions_raw,
+    addresses_path=config.paths.addresses,
+    output_dir=config.output.dir,
+    intermediate_dir=config.files.intermediate_dir,
+    run_id=None,
+    workers=config.pipeline.parse_workers,
+    chunk_size=config.ingest.chunk_size,
+    cache_path=config.cache.parse_path,
+):
+    """Run parse -> match -> fallback over files, without a database.
+
+    Transactions are streamed chunk by chunk, so they can be larger than
+    RAM. The reference is held in memory, as in the database mode. The
+    outputs have the same layout as the export_csv exports. With
+    intermediate_dir, the parsed transactions are also kept as Parquet.
+    cache_path=None keeps the parse cache in memory for this run only.
+    """
+    run_id = run_id or new_run_id()
+    os.makedirs(output_dir, exist_ok=True)
+    with metrics.timer("stage_seconds", stage="reference"):
+        ref = load_reference(addresses_path)
+    metrics.inc("rows_in_total", len(ref), stage="reference")
+    matches_out = CsvAppender(
+        os.path.join(output_dir, config.output.matches_csv), [column.name for column in match_results.columns]
+    )
+    unmatched_out = CsvAppender(
+        os.path.join(output_dir, config.output.unmatched_csv), [column.name for column in unmatched_report.columns]
+    )
+    parsed_out = None
+    if intermediate_dir:
+        os.makedirs(intermediate_dir, exist_ok=True)
+        parsed_schema = arrow_schema(transactions_parsed)
+        parsed_out = pq.ParquetWriter(os.path.join(intermediate_dir, "transactions_parsed.parquet"), parsed_schema)
+
+    workers = parse_workers(workers)
+    pool = make_parse_pool(workers)
+    cache = ParseCache(path=cache_path) if config.cache.parse_enabled else None
+    memo = KeyMemo()
+    try:
+        chunks = read_table_chunks(transactions_path, transactions_raw, chunk_size=chunk_size)
+        while True:
+            batch_start = time.perf_counter()
+            with metrics.timer("phase_seconds", stage="files", phase="fetch"):
+                chunk = next(chunks, None)
+            if chunk is None:
+                break
+            with metrics.timer("phase_seconds", stage="files", phase="compute"):
+                with metrics.timer("stage_seconds", stage="parse"):
+                    parsed_rows, parse_failures = parse_batch(chunk, pool, cache, workers)
+                parsed_df = pd.DataFrame(parsed_rows, columns=[column.name for column in transactions_parsed.columns])
+                # the spatial stage reads the raw coordinates, which transactions_parsed does not keep
+                match_df = parsed_df.merge(chunk[["id", *COORDINATE_COLUMNS]], on="id", how="left")
+                with metrics.timer("stage_seconds", stage="match"):
+                    matches, report = match_transactions(match_df, ref, memo=memo) if not parsed_df.empty else (pd.DataFrame(), pd.DataFrame())
+            record_parse_metrics(len(chunk), parsed_rows, parse_failures, cache)
+            metrics.inc("rows_in_total", len(parsed_df), stage="match")
+            metrics.inc("rows_out_total", len(matches), stage="match")
+
+            with metrics.timer("phase_seconds", stage="files", phase="write"):
+                if parsed_out is not None and not parsed_df.empty:
+                    parsed_out.write_table(pa.Table.from_pandas(parsed_df, schema=parsed_schema, preserve_index=False))
+                if not matches.empty:
+                    # mirror the SERIAL id of match_results
+                    matches.insert(0, "id", range(matches_out.rows + 1, matches_out.rows + len(matches) + 1))
+                matches_out.append(matches.assign(run_id=run_id))
+                unmatched_out.append(pd.DataFrame(parse_failures).assign(run_id=run_id))
+                unmatched_out.append(report.assign(run_id=run_id))
+            metrics.observe_time("batch_seconds", time.perf_counter() - batch_start, stage="files")
+            logger.info(f"Processed {len(chunk)} transactions: {len(parsed_rows)} parsed, {len(matches)} matches")
+    finally:
+        if parsed_out is not None:
+            parsed_out.close()
+        if pool is not None:
+            pool.shutdown()
+        if cache is not None:
+            cache.close()
+    logger.info(f"Wrote {matches_out.rows} matches to {matches_out.path} and {unmatched_out.rows} rows to {unmatched_out.path}")
+
+if __name__ == "__main__":
+    run_file_pipeline()
@@ -1,8 +1,15 @@
 from config import config
-from db import get_connection
+from datetime import datetime
+from db import get_connection, copy_dataframe, migrate
+from ledger import begin_stage, finish_stage, DONE
+from metrics import metrics
+from normalize import phonetic_keys
+from schema import addresses, transactions_raw
+import hashlib
 import logging
 import pandas as pd
 import sqlalchemy
+import time
 
 logging.basicConfig(
     level=logging.INFO,
@@ -11,46 +18,237 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 engine = get_connection()
 
-def ingest_address(csv_path):
-    df = pd.read_csv(csv_path)
+def add_phonetic_keys(df):
+    """Store the street metaphone codes with each address so the fallback never recomputes them."""
+    codes = {street: phonetic_keys(street) for street in df["street"].dropna().unique()}
+    df["street_metaphone"] = df["street"].map(lambda s: codes.get(s, (None, None))[0])
+    df["street_metaphone_alt"] = df["street"].map(lambda s: codes.get(s, (None, None))[1])
+    return df
+
+def prepare_addresses(df):
     df = df.rename(columns={"address": "full_address"})
-    with engine.begin() as conn:
-        conn.execute(sqlalchemy.text("TRUNCATE TABLE addresses CASCADE;"))
-    df.to_sql(
-        "addresses",
-        engine,
-        if_exists="append",
-        index=False
-    )
-    logger.info(f"Inserted {len(df)} rows into addresses table.")
+    return add_phonetic_keys(df)
+
+def conform_chunk(df, table):
+    """Keep the CSV columns that exist in the table and cast numeric columns to the table's types."""
+    df = df[[column.name for column in table.columns if column.name in df.columns]].copy()
+    for column in table.columns:
+        if column.name not in df:
+            continue
+        if isinstance(column.type, sqlalchemy.Integer):
+            df[column.name] = pd.to_numeric(df[column.name], errors="coerce").round().astype("Int64")
+        elif isinstance(column.type, sqlalchemy.Float):
+            df[column.name] = pd.to_numeric(df[column.name], errors="coerce")
+    return df
+
+def row_hashes(df):
+    """Content fingerprint of each row, used to tell changed rows from unchanged ones on incremental loads."""
+    values = df.astype(object).where(df.notna(), "").astype(str)
+    joined = values.apply("\x1f".join, axis=1)
+    return joined.map(lambda row: hashlib.md5(row.encode("utf-8")).hexdigest())
+
+def read_csv_chunks(csv_path, table, prepare=None, chunk_size=config.ingest.chunk_size, fingerprint=True):
+    """Yield the CSV in chunks of chunk_size rows, shaped for the target table and fingerprinted."""
+    for chunk in pd.read_csv(csv_path, dtype=str, chunksize=chunk_size):
+        if prepare is not None:
+            chunk = prepare(chunk)
+        chunk = conform_chunk(chunk, table)
+        if fingerprint:
+            chunk["content_hash"] = row_hashes(chunk) if len(chunk) else pd.Series(dtype=str)
+        yield chunk
 
-def ingest_transactions(csv_path):
-    df = pd.read_csv(csv_path)
+def copy_csv(csv_path, table, prepare=None):
+    """Replace the table contents with the CSV, streamed chunk by chunk through COPY in one transaction."""
+    total = 0
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(f"TRUNCATE TABLE {table.name} CASCADE;")
+            for chunk in read_csv_chunks(csv_path, table, prepare):
+                copy_dataframe(cursor, table.name, chunk)
+                total += len(chunk)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return total
+
+def insert_csv(csv_path, table, prepare=None):
+    """Replace the table contents with the CSV through DataFrame.to_sql INSERTs."""
+    total = 0
     with engine.begin() as conn:
-        conn.execute(sqlalchemy.text("TRUNCATE TABLE transactions_raw CASCADE;"))
-    df.to_sql(
-        "transactions_raw",
-        engine,
-        if_exists="append",
-        index=False
+        conn.execute(sqlalchemy.text(f"TRUNCATE TABLE {table.name} CASCADE;"))
+    for chunk in read_csv_chunks(csv_path, table, prepare):
+        chunk.to_sql(
+            table.name,
+            engine,
+            if_exists="append",
+            index=False
+        )
+        total += len(chunk)
+    return total
+
+INGEST_METHODS = {
+    "copy": copy_csv,
+    "to_sql": insert_csv,
+}
+
+# columns whose change invalidates the parse and match results of a transaction
+TRANSACTION_ADDRESS_COLUMNS = ["address_line_1", "address_line_2", "city", "state", "zip_code"]
+
+# statements removing the rows that reference a set of ids held in the temp table "{ids}"
+DEPENDENT_DELETES = {
+    "transactions_raw": [
+        "DELETE FROM match_results WHERE transaction_id IN (SELECT id FROM {ids})",
+        "DELETE FROM unmatched_report WHERE transaction_id IN (SELECT id FROM {ids})",
+        "DELETE FROM transactions_parsed WHERE id IN (SELECT id FROM {ids})",
+    ],
+    "addresses": [
+        "DELETE FROM match_results WHERE address_id IN (SELECT id FROM {ids})",
+    ],
+}
+
+def delete_dependents(cursor, table, ids):
+    for statement in DEPENDENT_DELETES[table.name]:
+        cursor.execute(statement.format(ids=ids))
+
+def upsert_csv(csv_path, table, prepare=None, delete_missing=config.ingest.delete_missing):
+    """Apply the CSV to the table as a delta and log every inserted, updated and deleted id in ingest_changes.
+
+    Rows are staged with COPY, then upserted on the primary key. Unchanged
+    rows (same content_hash) are left untouched. A transaction whose address
+    columns changed loses its parsed row and results, so parse and match pick
+    it up again. With delete_missing, rows absent from the CSV are removed
+    together with their dependents.
+    """
+    changed_at = datetime.now().isoformat()
+    columns = [column.name for column in table.columns]
+    column_list = ", ".join(columns)
+    updates = ", ".join(f"{name} = EXCLUDED.{name}" for name in columns if name != "id")
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(f"CREATE TEMP TABLE staging (LIKE {table.name}) ON COMMIT DROP")
+            for chunk in read_csv_chunks(csv_path, table, prepare):
+                copy_dataframe(cursor, "staging", chunk)
+
+            if table.name == transactions_raw.name:
+                old = ", ".join(f"t.{name}" for name in TRANSACTION_ADDRESS_COLUMNS)
+                new = ", ".join(f"s.{name}" for name in TRANSACTION_ADDRESS_COLUMNS)
+                cursor.execute(
+                    f"CREATE TEMP TABLE readdressed ON COMMIT DROP AS "
+                    f"SELECT t.id FROM {table.name} t JOIN staging s ON s.id = t.id "
+                    f"WHERE ({old}) IS DISTINCT FROM ({new})"
+                )
+                delete_dependents(cursor, table, "readdressed")
+
+            cursor.execute(
+                f"WITH upserted AS ("
+                f"  INSERT INTO {table.name} ({column_list})"
+                f"  SELECT DISTINCT ON (id) {column_list} FROM staging ORDER BY id"
+                f"  ON CONFLICT (id) DO UPDATE SET {updates}"
+                f"  WHERE {table.name}.content_hash IS DISTINCT FROM EXCLUDED.content_hash"
+                f"  RETURNING id, (xmax = 0) AS inserted"
+                f") "
+                f"INSERT INTO ingest_changes (table_name, record_id, change_type, changed_at) "
+                f"SELECT %s, id::text, CASE WHEN inserted THEN 'insert' ELSE 'update' END, %s FROM upserted",
+                (table.name, changed_at),
+            )
+
+            if delete_missing:
+                cursor.execute(
+                    f"CREATE TEMP TABLE removed ON COMMIT DROP AS "
+                    f"SELECT t.id FROM {table.name} t WHERE NOT EXISTS (SELECT 1 FROM staging s WHERE s.id = t.id)"
+                )
+                delete_dependents(cursor, table, "removed")
+                cursor.execute(f"DELETE FROM {table.name} WHERE id IN (SELECT id FROM removed)")
+                cursor.execute(
+                    "INSERT INTO ingest_changes (table_name, record_id, change_type, changed_at) "
+                    "SELECT %s, id::text, 'delete', %s FROM removed",
+                    (table.name, changed_at),
+                )
+
+            cursor.execute(
+                "SELECT change_type, count(*) FROM ingest_changes "
+                "WHERE table_name = %s AND changed_at = %s GROUP BY change_type",
+                (table.name, changed_at),
+            )
+            counts = dict(cursor.fetchall())
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    logger.info(
+        f"{table.name}: {counts.get('insert', 0)} inserted, {counts.get('update', 0)} updated, "
+        f"{counts.get('delete', 0)} deleted"
     )
-    logger.info(f"Inserted {len(df)} rows into transactions_raw table.")
+    return sum(counts.values())
+
+def ingest_address(csv_path, method=config.ingest.method, mode=config.ingest.mode):
+    if mode == "incremental":
+        return upsert_csv(csv_path, addresses, prepare=prepare_addresses)
+    total = INGEST_METHODS[method](csv_path, addresses, prepare=prepare_addresses)
+    logger.info(f"Inserted {total} rows into addresses table.")
+    return total
 
-def load_data():
+def ingest_transactions(csv_path, method=config.ingest.method, mode=config.ingest.mode):
+    if mode == "incremental":
+        return upsert_csv(csv_path, transactions_raw)
+    total = INGEST_METHODS[method](csv_path, transactions_raw)
+    logger.info(f"Inserted {total} rows into transactions_raw table.")
+    return total
+
+def load_data(mode=config.ingest.mode, run_id=None):
     """
     Load data from CSV files into the database.
+
+    With run_id, each table's load is recorded in run_ledger, and a resumed
+    run skips the tables it already loaded. A table is replaced or upserted
+    as a whole, so a load that was interrupted simply runs again. Errors are
+    re-raised then, so the caller stops before the later stages run on a
+    partial load and mark the run done.
     """
     try:
-        logger.info("Loading addresses...")
-        ingest_address(config.paths.addresses)
-        logger.info("Loading transactions...")
-        ingest_transactions(config.paths.transactions_raw)
+        for name, ingest, csv_path in [
+            ("addresses", ingest_address, config.paths.addresses),
+            ("transactions_raw", ingest_transactions, config.paths.transactions_raw),
+        ]:
+            stage = f"ingest.{name}"
+            if run_id is not None and begin_stage(run_id, stage)["status"] == DONE:
+                continue
+            logger.info(f"Loading {name} ({mode})...")
+            rows = ingest(csv_path, mode=mode)
+            metrics.inc("rows_out_total", rows, stage="ingest", table=name)
+            if run_id is not None:
+                finish_stage(run_id, stage, rows_out=rows)
     except sqlalchemy.exc.IntegrityError as e:
         logger.error(f"Integrity error: {e}")
+        if run_id is not None:
+            raise
     except Exception as e:
         logger.error(f"An error occurred: {e}")
+        if run_id is not None:
+            raise
     else:
         logger.info("Data loaded successfully.")
 
+def benchmark_ingest():
+    """Compare rows/sec of the COPY and to_sql loaders on the configured files. Reloads both tables."""
+    for method in INGEST_METHODS:
+        for name, ingest, csv_path in [
+            ("addresses", ingest_address, config.paths.addresses),
+            ("transactions_raw", ingest_transactions, config.paths.transactions_raw),
+        ]:
+            start = time.perf_counter()
+            total = ingest(csv_path, method=method, mode="full")
+            elapsed = time.perf_counter() - start
+            logger.info(f"[BENCHMARK] {method} {name}: {total} rows in {elapsed:.2f}s ({total / elapsed:.0f} rows/sec)")
+
 if __name__ == "__main__":
+    migrate()
     load_data()
+    #benchmark_ingest()
@@ -0,0 +1,98 @@
+from datetime import datetime
+from db import get_connection
+from sqlalchemy import text
+import logging
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+logger = logging.getLogger(__name__)
+
+engine = get_connection()
+
+# status of a run_ledger row
+RUNNING = "running"
+DONE = "done"
+
+# run with a DB-API cursor, inside the transaction that writes the rows it accounts for
+CHECKPOINT_SQL = """
+UPDATE run_ledger
+SET last_key = %(last_key)s,
+    rows_in = rows_in + %(rows_in)s,
+    rows_out = rows_out + %(rows_out)s,
+    updated_at = %(updated_at)s
+WHERE run_id = %(run_id)s AND stage = %(stage)s
+"""
+
+def begin_stage(run_id, stage, on_start=None):
+    """The run_ledger row of stage in run_id as a dict, created on the first call.
+
+    A stage that is already running resumes after its last_key. on_start
+    runs in the transaction that creates the row, e.g. to clear the results
+    a fresh start replaces, so that a crash right after it still resumes
+    instead of clearing again.
+    """
+    with engine.begin() as conn:
+        row = conn.execute(
+            text("SELECT status, last_key, rows_in, rows_out FROM run_ledger WHERE run_id = :run_id AND stage = :stage"),
+            {"run_id": run_id, "stage": stage},
+        ).mappings().first()
+        if row is None:
+            now = datetime.now().isoformat()
+            conn.execute(
+                text(
+                    "INSERT INTO run_ledger (run_id, stage, status, last_key, rows_in, rows_out, started_at, updated_at) "
+                    "VALUES (:run_id, :stage, :status, NULL, 0, 0, :now, :now)"
+                ),
+                {"run_id": run_id, "stage": stage, "status": RUNNING, "now": now},
+            )
+            if on_start is not None:
+                on_start(conn)
+            return {"status": RUNNING, "last_key": None, "rows_in": 0, "rows_out": 0}
+    row = dict(row)
+    if row["status"] == DONE:
+        logger.info(f"Stage {stage} of run {run_id} already finished; skipping it")
+    else:
+        logger.info(f"Resuming stage {stage} of run {run_id} after {row['last_key']} ({row['rows_in']} rows done)")
+    return row
+
+def checkpoint(cursor, run_id, stage, last_key, rows_in=0, rows_out=0):
+    """Move the stage's last_key forward and add to its row counts, on the writer's own transaction."""
+    cursor.execute(
+        CHECKPOINT_SQL,
+        {
+            "run_id": run_id,
+            "stage": stage,
+            "last_key": None if last_key is None else str(last_key),
+            "rows_in": int(rows_in),
+            "rows_out": int(rows_out),
+            "updated_at": datetime.now().isoformat(),
+        },
+    )
+
+def finish_stage(run_id, stage, rows_in=0, rows_out=0):
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                "UPDATE run_ledger SET status = :status, rows_in = rows_in + :rows_in, rows_out = rows_out + :rows_out, "
+                "updated_at = :now WHERE run_id = :run_id AND stage = :stage"
+            ),
+            {
+                "run_id": run_id,
+                "stage": stage,
+                "status": DONE,
+                "rows_in": int(rows_in),
+                "rows_out": int(rows_out),
+                "now": datetime.now().isoformat(),
+            },
+        )
+
+def latest_unfinished_run(stage):
+    """The most recent run_id whose stage row never finished, or None.
+
+    Runs of the standalone scripts have no row for the stage spanning the
+    whole pipeline, so they are never picked up for it.
+    """
+    with engine.begin() as conn:
+        return conn.execute(
+            text("SELECT max(run_id) FROM run_ledger WHERE stage = :stage AND status <> :status"),
+            {"stage": stage, "status": DONE},
+        ).scalar()
@@ -1,9 +1,54 @@
 from config import config
+from db import migrate, new_run_id
+from file_pipeline import run_file_pipeline
 from ingest import load_data
+from ledger import begin_stage, finish_stage, latest_unfinished_run
 from parse import normalize_and_parse
 from match import run_match
+from metrics import metrics
+import argparse
+
+# run_ledger stage spanning the whole database pipeline, so that a run between two stages still counts as unfinished
+PIPELINE_STAGE = "pipeline"
+LATEST = "latest"
 
 if __name__ == "__main__":
-    load_data()
-    normalize_and_parse()
-    run_match()
+    parser = argparse.ArgumentParser(description="Run the address matching pipeline.")
+    parser.add_argument(
+        "--files",
+        action="store_true",
+        help="read config.paths directly and write the output CSVs without a database",
+    )
+    parser.add_argument(
+        "--resume",
+        nargs="?",
+        const=LATEST,
+        metavar="RUN_ID",
+        help="continue an interrupted run from the last checkpoint of each stage; without RUN_ID, the latest unfinished run",
+    )
+    args = parser.parse_args()
+
+    if args.resume and args.files:
+        parser.error("--resume needs the database; the file pipeline keeps no checkpoints")
+    if not args.files:
+        migrate()
+    run_id = args.resume if args.resume != LATEST else latest_unfinished_run(PIPELINE_STAGE)
+    if args.resume and run_id is None:
+        parser.error("there is no unfinished run to resume")
+    run_id = run_id or new_run_id()
+    try:
+        if args.files:
+            with metrics.timer("stage_seconds", stage="files"):
+                run_file_pipeline(run_id=run_id)
+        else:
+            begin_stage(run_id, PIPELINE_STAGE)
+            with metrics.timer("stage_seconds", stage="ingest"):
+                load_data(run_id=run_id)
+            with metrics.timer("stage_seconds", stage="parse"):
+                normalize_and_parse(run_id=run_id)
+            with metrics.timer("stage_seconds", stage="match"):
+                run_match(run_id=run_id)
+            finish_stage(run_id, PIPELINE_STAGE)
+    finally:
+        # a partial run's numbers are still worth keeping
+        metrics.write()
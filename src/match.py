@@ -1,27 +1,79 @@
+from batches import run_batches
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from config import config
 from datetime import datetime
-from db import get_connection
-from fallback import run_fallbacks
-from rapidfuzz import fuzz
+from db import get_connection, get_state, migrate, new_run_id, set_state
+from fallback import run_fallbacks, phonetic_address_ids, PHONETIC_CONFIDENCE
+from ledger import begin_stage, finish_stage, DONE
+from metrics import metrics
+from normalize import phonetic_keys
+from rapidfuzz import fuzz, process
+from reference import (
+    address_tokens,
+    build_blocks,
+    rounded_coordinates,
+    shard_condition,
+    street_key,
+    street_keys,
+    ReferenceIndex,
+    COORDINATE_COLUMNS,
+    EXACT_TXN_FIELDS,
+    EXACT_ADDR_FIELDS,
+    METERS_PER_DEGREE_LAT,
+    METERS_PER_DEGREE_LON,
+)
 from schema import (
+    transactions_raw,
     transactions_parsed,
     addresses,
     match_results,
     unmatched_report
 )
-from sqlalchemy import select, text
+from sqlalchemy import and_, exists, insert, literal, or_, select, text
+from writer import BufferedWriter
 import logging
+import numpy as np
 import pandas as pd
 import sqlalchemy
 
 
-logging.basicConfig(level=logging.DEBUG, format="%(asctime)s [%(levelname)s] %(message)s")
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 logger = logging.getLogger(__name__)
 
 engine = get_connection()
 
 BATCH_SIZE = config.pipeline.batch_size
+SPATIAL_RADIUS_M = config.pipeline.spatial_radius_m
 FUZZY_THRESHOLD = config.pipeline.fuzzy_threshold
+DEFAULT_STRATEGIES = ("exact", "fuzzy")
+TOKEN_TOP_K = config.pipeline.token_top_k
+
+UNMATCHED_REASON = "low fuzzy score"
+# pipeline_state key holding the last ingest_changes id already applied to match results
+ADDRESS_CHANGES_KEY = "match.address_changes"
+# transactions that reached the token stage on the street and zip of a changed address, where it accepts house number typos
+SAME_STREET_AS_CHANGED_ADDRESSES_SQL = (
+    "SELECT t.id FROM transactions_parsed t "
+    "JOIN addresses a ON a.zip = t.zip AND a.street = t.street_name AND a.strtype IS NOT DISTINCT FROM t.street_type "
+    "WHERE a.id IN (SELECT id FROM changed_addresses) AND t.id IN ("
+    "SELECT transaction_id FROM unmatched_report WHERE reason = :reason "
+    "UNION SELECT transaction_id FROM match_results WHERE match_type IN ('token', 'spatial'))"
+)
+# transactions that reached the spatial stage and lie in the box around a changed address; the box contains the spatial radius
+NEAR_CHANGED_ADDRESSES_SQL = (
+    "SELECT r.id FROM ("
+    "SELECT transaction_id FROM unmatched_report WHERE reason = :reason "
+    "UNION SELECT transaction_id FROM match_results WHERE match_type = 'spatial'"
+    ") reached JOIN transactions_raw r ON r.id = reached.transaction_id "
+    "JOIN addresses a ON a.id IN (SELECT id FROM changed_addresses) "
+    "AND r.latitude BETWEEN a.latitude - :lat_radius AND a.latitude + :lat_radius "
+    "AND r.longitude BETWEEN a.longitude - :lon_radius / cos(radians(a.latitude)) "
+    "AND a.longitude + :lon_radius / cos(radians(a.latitude))"
+)
+# run_ledger stage of the whole match run and of the single INSERT ... SELECT exact stage
+MATCH_STAGE = "match"
+EXACT_SQL_STAGE = "match.exact_sql"
 
 EXACT_FIELDS = [
     (transactions_parsed.c.street_number, addresses.c.house),
@@ -33,17 +85,77 @@ EXACT_FIELDS = [
     (transactions_parsed.c.state, addresses.c.state),
     (transactions_parsed.c.zip, addresses.c.zip),
 ]
+# fields that are often null on both sides and must compare null-safely
+NULL_SAFE_EXACT_FIELDS = {"street_type", "unit_type", "unit_identifier"}
 
 
-def fetch_unmatched_batch(offset):
-    statement = select(transactions_parsed).offset(offset).limit(BATCH_SIZE)
+def fetch_unmatched_batch(last_id=None, pending_only=False, skip_matched=False, shard=None, shards=1):
+    """Next BATCH_SIZE parsed transactions (with raw coordinates) after last_id, optionally unmatched/pending only and of one shard."""
+    statement = (
+        select(transactions_parsed, transactions_raw.c.latitude, transactions_raw.c.longitude)
+        .select_from(transactions_parsed.join(transactions_raw, transactions_raw.c.id == transactions_parsed.c.id))
+        .order_by(transactions_parsed.c.id)
+        .limit(BATCH_SIZE)
+    )
+    if pending_only or skip_matched:
+        statement = statement.where(~exists().where(match_results.c.transaction_id == transactions_parsed.c.id))
+    if pending_only:
+        statement = statement.where(
+            ~exists().where(
+                unmatched_report.c.transaction_id == transactions_parsed.c.id,
+                unmatched_report.c.reason == UNMATCHED_REASON,
+            ),
+        )
+    if shard is not None:
+        statement = statement.where(
+            shard_condition(transactions_parsed.c.street_number, shard, shards, include_null=True)
+        )
+    if last_id is not None:
+        statement = statement.where(transactions_parsed.c.id > last_id)
     return pd.read_sql(statement, engine)
 
-def exact_match(txn_df, addr_df):
+def exact_match_in_db(pending_only=False, run_id=None):
+    """Insert every exact match with one INSERT ... SELECT joined inside PostgreSQL; returns the row count."""
+    conditions = []
+    for txn_column, addr_column in EXACT_FIELDS:
+        if txn_column.name in NULL_SAFE_EXACT_FIELDS:
+            conditions.append(or_(txn_column == addr_column, and_(txn_column.is_(None), addr_column.is_(None))))
+        else:
+            conditions.append(txn_column == addr_column)
+    query = (
+        select(
+            transactions_parsed.c.id,
+            addresses.c.id,
+            literal("exact"),
+            literal(1.0),
+            literal(datetime.now().isoformat()),
+            literal(run_id),
+        )
+        .select_from(transactions_parsed.join(addresses, and_(*conditions)))
+        .where(~exists().where(match_results.c.transaction_id == transactions_parsed.c.id))
+    )
+    if pending_only:
+        query = query.where(
+            ~exists().where(
+                unmatched_report.c.transaction_id == transactions_parsed.c.id,
+                unmatched_report.c.reason == UNMATCHED_REASON,
+            )
+        )
+    statement = insert(match_results).from_select(
+        ["transaction_id", "address_id", "match_type", "confidence_score", "matched_at", "run_id"],
+        query,
+    )
+    with metrics.timer("matcher_seconds", matcher="exact_sql"), engine.begin() as conn:
+        inserted = conn.execute(statement).rowcount
+    metrics.inc("matcher_rows_out_total", inserted, matcher="exact_sql")
+    logger.info(f"Inserted {inserted} exact matches into match_results in the database.")
+    return inserted
+
+def exact_match(txn_df, ref):
     merged = txn_df.merge(
-        addr_df,
-        left_on=["street_number", "street_name", "street_type", "unit_type", "unit_identifier", "city", "state", "zip"],
-        right_on=["house", "street", "strtype", "apttype", "aptnbr", "city", "state", "zip"],
+        ref.df,
+        left_on=EXACT_TXN_FIELDS,
+        right_on=EXACT_ADDR_FIELDS,
         how='inner',
         suffixes=("_txn", "_addr")
     )
@@ -54,97 +166,435 @@ def exact_match(txn_df, addr_df):
         ["id_txn", "id_addr", "match_type", "confidence_score", "matched_at"]
     ].rename(columns={"id_txn": "transaction_id", "id_addr": "address_id"})
 
-def fuzzy_match(txn_df, addr_df):
+def pick_best_unit(tx_unit, addr_units):
+    """Among equally scored candidates, prefer the same unit, then a candidate without one; None if all conflict."""
+    if pd.isna(tx_unit):
+        return 0
+    fallback = None
+    for i, addr_unit in enumerate(addr_units):
+        if addr_unit == tx_unit:
+            return i
+        if fallback is None and pd.isna(addr_unit):
+            fallback = i
+    return fallback
+
+def score_block(txn_streets, positions, ref, keys=None):
+    """token_sort_ratio of each transaction street against a candidate block. Scores below the cutoff are 0.
+
+    keys are the reference strings to score against, street_keys by default.
+    """
+    keys = ref.street_keys if keys is None else keys
+    return process.cdist(
+        txn_streets,
+        keys[positions],
+        scorer=fuzz.token_sort_ratio,
+        score_cutoff=FUZZY_THRESHOLD * 100,
+        dtype=np.float64,
+    )
+
+def pick_fuzzy_match(unit_identifier, row_scores, positions, ref, matcher="fuzzy"):
+    """(address_id, confidence) of the best candidate in one row of score_block, or None.
+
+    Ties go to the first candidate in positions order after the unit preference.
+    """
+    top = row_scores.max()
+    if top == 0:
+        return None
+    tied = np.flatnonzero(row_scores == top)
+    col = pick_best_unit(unit_identifier, ref.units[positions[tied]])
+    if col is None:
+        metrics.inc("unit_mismatches_total", matcher=matcher)
+        return None
+    return ref.ids[positions[tied[col]]], top / 100
+
+def fuzzy_match(txn_df, ref):
+    """Score each zip/house/city group of transactions against its candidate block in one cdist call."""
     results = []
-    for _, txn in txn_df.iterrows():
-        # blocking by zip, street number, and city
-        candidates = addr_df[
-            (addr_df.zip == txn.zip) &
-            (addr_df.house == txn.street_number) &
-            (addr_df.city == txn.city)
-        ]
-        best_score = 0
-        best_match = None
-        txn_street = f"{txn.street_name} {txn.street_type or ''}".strip()
-        for _, addr in candidates.iterrows():
-            addr_street = f"{addr.street} {addr.strtype or ''}".strip()
-            score = fuzz.token_sort_ratio(txn_street, addr_street)
-            if score > best_score:
-                best_score = score / 100
-                best_match = addr
-        if best_score >= FUZZY_THRESHOLD and best_match is not None:
-            # Check unit identifier
-            if txn.unit_identifier and best_match.aptnbr:
-                if txn.unit_identifier != best_match.aptnbr:
-                    logger.debug(f"Unit mismatch: TX={txn.unit_identifier} vs {best_match.aptnbr}")
-                    continue  # skip this match
-            logger.debug(f"Fuzzy match found for transaction {txn.id} with address {best_match.id} with score {best_score}")
+    matched_at = datetime.now().isoformat()
+    # plain arrays: indexing them per group is far cheaper than slicing and iterating DataFrames
+    ids = txn_df.id.to_numpy(dtype=object)
+    units = txn_df.unit_identifier.to_numpy(dtype=object)
+    streets = street_keys(txn_df.street_name, txn_df.street_type).to_numpy(dtype=object)
+    for key, rows in build_blocks(txn_df, ["zip", "street_number", "city"]).items():
+        positions = ref.fuzzy_blocks.get(key)
+        if positions is None:
+            metrics.inc("candidate_block_misses_total", len(rows), matcher="fuzzy")
+            continue
+        metrics.observe("candidate_block_size", len(positions), count=len(rows), matcher="fuzzy")
+        scores = score_block(streets[rows].tolist(), positions, ref)
+        for row, row_scores in zip(rows, scores):
+            best = pick_fuzzy_match(units[row], row_scores, positions, ref)
+            if best is None:
+                continue
+            address_id, best_score = best
             results.append({
-                "transaction_id": txn.id,
-                "address_id": best_match.id,
+                "transaction_id": ids[row],
+                "address_id": address_id,
                 "match_type": "fuzzy",
                 "confidence_score": best_score,
-                "matched_at": datetime.now().isoformat()
+                "matched_at": matched_at
+            })
+    return pd.DataFrame(results)
+
+def house_street_key(street_number, street_name, street_type):
+    """The transaction side of ReferenceIndex.house_street_keys."""
+    house = "" if pd.isna(street_number) else str(street_number)
+    return f"{house} {street_key(street_name, street_type)}".strip()
+
+def is_house_typo(house, candidate):
+    """Whether candidate is house with two adjacent characters swapped, or with one character doubled or undoubled.
+
+    Any other change may be a different house: 125 or 1234 for 123 is not a typo of it.
+    """
+    if len(house) == len(candidate):
+        diffs = [i for i, (a, b) in enumerate(zip(house, candidate)) if a != b]
+        return (
+            len(diffs) == 2
+            and diffs[1] == diffs[0] + 1
+            and house[diffs[0]] == candidate[diffs[1]]
+            and house[diffs[1]] == candidate[diffs[0]]
+        )
+    shorter, longer = sorted((house, candidate), key=len)
+    return len(longer) - len(shorter) == 1 and any(
+        longer[i] == longer[i - 1] and longer[:i] + longer[i + 1:] == shorter for i in range(1, len(longer))
+    )
+
+def house_guard(street_number, street, zip_code, positions, ref, matcher):
+    """The candidate positions whose house number is the same, or on the same street and zip a typo of it."""
+    if pd.isna(street_number):
+        return positions[:0]
+    house = str(street_number)
+    houses = ref.houses[positions]
+    keep = houses == house
+    if ref.house_typos:
+        for i in np.flatnonzero(~keep):
+            position = positions[i]
+            keep[i] = (
+                ref.street_keys[position] == street
+                and ref.zips[position] == zip_code
+                and isinstance(houses[i], str)
+                and is_house_typo(house, houses[i])
+            )
+    metrics.inc("house_guard_rejects_total", len(keep) - int(keep.sum()), matcher=matcher)
+    return positions[keep]
+
+def pick_spatial_match(latitude, longitude, street_number, street_name, street_type, zip_code, unit_identifier, ref):
+    """(address_id, confidence) of the best scored address within spatial_radius_m of the point that passes house_guard, or None."""
+    street = street_key(street_name, street_type)
+    positions = house_guard(street_number, street, zip_code, ref.grid.near(latitude, longitude), ref, "spatial")
+    if not len(positions):
+        metrics.inc("candidate_block_misses_total", matcher="spatial")
+        return None
+    metrics.observe("candidate_block_size", len(positions), matcher="spatial")
+    house_street = house_street_key(street_number, street_name, street_type)
+    row_scores = score_block([house_street], positions, ref, ref.house_street_keys)[0]
+    # positions are nearest first, so equal scores go to the closest address
+    return pick_fuzzy_match(unit_identifier, row_scores, positions, ref, matcher="spatial")
+
+def spatial_match(txn_df, ref):
+    """Score each transaction against the house_guard-ed addresses near its coordinates, whatever their zip or city."""
+    if ref.grid is None or txn_df.empty or not all(column in txn_df for column in COORDINATE_COLUMNS):
+        return pd.DataFrame()
+    results = []
+    matched_at = datetime.now().isoformat()
+    latitudes, longitudes = rounded_coordinates(txn_df)
+    for txn, latitude, longitude in zip(txn_df.itertuples(index=False), latitudes, longitudes):
+        if np.isnan(latitude) or np.isnan(longitude):
+            metrics.inc("candidate_block_misses_total", matcher="spatial")
+            continue
+        best = pick_spatial_match(
+            latitude, longitude, txn.street_number, txn.street_name, txn.street_type, txn.zip, txn.unit_identifier, ref
+        )
+        if best is None:
+            continue
+        address_id, best_score = best
+        results.append({
+            "transaction_id": txn.id,
+            "address_id": address_id,
+            "match_type": "spatial",
+            "confidence_score": best_score,
+            "matched_at": matched_at
         })
     return pd.DataFrame(results)
 
+def pick_token_match(tokens, token_key, street_number, street, zip_code, unit_identifier, ref, k=TOKEN_TOP_K):
+    """(address_id, confidence) of the best scored of the top k token index candidates that pass house_guard, or None."""
+    positions = house_guard(street_number, street, zip_code, ref.token_index.top_k(tokens, k), ref, "token")
+    if not len(positions):
+        metrics.inc("candidate_block_misses_total", matcher="token")
+        return None
+    metrics.observe("candidate_block_size", len(positions), matcher="token")
+    row_scores = score_block([token_key], positions, ref, ref.token_keys)[0]
+    # positions are best token overlap first, so equal scores go to the larger overlap
+    return pick_fuzzy_match(unit_identifier, row_scores, positions, ref, matcher="token")
+
+def record_tokens(street_number, street_name, street_type, unit_identifier, zip_code):
+    """(address_tokens, token key) of a parsed transaction, the counterparts of the token index and ref.token_keys."""
+    street = street_key(street_name, street_type)
+    tokens = address_tokens(street_number, street, unit_identifier, zip_code)
+    zip_code = "" if pd.isna(zip_code) else str(zip_code)
+    return tokens, f"{house_street_key(street_number, street_name, street_type)} {zip_code}".strip()
+
+def token_match(txn_df, ref):
+    """Score each transaction against its house_guard-ed top TOKEN_TOP_K token index candidates."""
+    if not TOKEN_TOP_K or txn_df.empty:
+        return pd.DataFrame()
+    results = []
+    matched_at = datetime.now().isoformat()
+    for txn in txn_df.itertuples(index=False):
+        tokens, token_key = record_tokens(txn.street_number, txn.street_name, txn.street_type, txn.unit_identifier, txn.zip)
+        street = street_key(txn.street_name, txn.street_type)
+        best = pick_token_match(tokens, token_key, txn.street_number, street, txn.zip, txn.unit_identifier, ref)
+        if best is None:
+            continue
+        address_id, best_score = best
+        results.append({
+            "transaction_id": txn.id,
+            "address_id": address_id,
+            "match_type": "token",
+            "confidence_score": best_score,
+            "matched_at": matched_at
+        })
+    return pd.DataFrame(results)
+
+def match_record(record, ref):
+    """The (address_id, match_type, confidence_score) matches of one parsed address, for online matching."""
+    positions = ref.exact_positions(record)
+    if positions:
+        return [(ref.ids[position], "exact", 1.0) for position in positions]
+
+    block = ref.fuzzy_blocks.get((record["zip"], record["street_number"], record["city"]))
+    if block is not None:
+        row_scores = score_block([street_key(record["street_name"], record["street_type"])], block, ref)[0]
+        best = pick_fuzzy_match(record["unit_identifier"], row_scores, block, ref)
+        if best is not None:
+            return [(best[0], "fuzzy", best[1])]
+
+    codes = [code for code in phonetic_keys(record["street_name"]) if code]
+    address_ids = phonetic_address_ids(record["street_number"], codes, record["unit_identifier"], ref)
+    if address_ids:
+        return [(address_id, "phonetic", PHONETIC_CONFIDENCE) for address_id in address_ids]
+
+    if TOKEN_TOP_K:
+        tokens, token_key = record_tokens(
+            record["street_number"], record["street_name"], record["street_type"], record["unit_identifier"], record["zip"]
+        )
+        street = street_key(record["street_name"], record["street_type"])
+        best = pick_token_match(
+            tokens, token_key, record["street_number"], street, record["zip"], record["unit_identifier"], ref
+        )
+        if best is not None:
+            return [(best[0], "token", best[1])]
+
+    latitude, longitude = record.get("latitude"), record.get("longitude")
+    if ref.grid is not None and pd.notna(latitude) and pd.notna(longitude):
+        best = pick_spatial_match(
+            latitude, longitude, record["street_number"], record["street_name"], record["street_type"], record["zip"],
+            record["unit_identifier"], ref,
+        )
+        if best is not None:
+            return [(best[0], "spatial", best[1])]
+    return []
+
+# "street strtype" computed in SQL; must match the expression of idx_addresses_street_trgm
+ADDRESS_STREET_KEY_SQL = "btrim(coalesce(a.street, '') || ' ' || coalesce(a.strtype, ''))"
+TRANSACTION_STREET_KEY_SQL = "btrim(coalesce(t.street_name, '') || ' ' || coalesce(t.street_type, ''))"
+
+TRIGRAM_MATCH_SQL = f"""
+SELECT transaction_id, address_id, score FROM (
+    SELECT DISTINCT ON (t.id)
+        t.id AS transaction_id,
+        a.id AS address_id,
+        similarity({ADDRESS_STREET_KEY_SQL}, {TRANSACTION_STREET_KEY_SQL}) AS score,
+        CASE
+            WHEN a.aptnbr = t.unit_identifier THEN 0
+            WHEN a.aptnbr IS NULL OR t.unit_identifier IS NULL THEN 1
+            ELSE 2
+        END AS unit_rank
+    FROM transactions_parsed t
+    JOIN addresses a ON a.zip = t.zip AND a.house = t.street_number AND a.city = t.city
+    WHERE t.id = ANY(:ids)
+      AND {ADDRESS_STREET_KEY_SQL} % {TRANSACTION_STREET_KEY_SQL}
+    ORDER BY t.id, score DESC, unit_rank, a.id
+) best
+WHERE unit_rank < 2
+"""
+
+def trigram_match(txn_df, ref):
+    """Fuzzy stage inside PostgreSQL with pg_trgm similarity, blocked by zip/house/city. ref is unused."""
+    if txn_df.empty:
+        return pd.DataFrame()
+    with engine.begin() as conn:
+        # the % operator uses this threshold and can be answered from the trigram index
+        conn.execute(text("SELECT set_config('pg_trgm.similarity_threshold', :threshold, true)"),
+                     {"threshold": str(FUZZY_THRESHOLD)})
+        matches = pd.read_sql(text(TRIGRAM_MATCH_SQL), conn, params={"ids": txn_df.id.tolist()})
+    matches = matches.rename(columns={"score": "confidence_score"})
+    matches["match_type"] = "trigram"
+    matches["matched_at"] = datetime.now().isoformat()
+    return matches[["transaction_id", "address_id", "match_type", "confidence_score", "matched_at"]]
+
 MATCHING_METHODS = {
     "exact": exact_match,
     "fuzzy": fuzzy_match,
+    "trigram": trigram_match,
+    "token": token_match,
 }
 
-def match_batch(offset=0) -> bool:
-    txn_df = fetch_unmatched_batch(offset)
-    if txn_df.empty:
-        logger.info("No more unmatched transactions to process.")
-        return False
+def run_matcher(matcher, match_function, unmatched, ref):
+    """Run one matcher over the unmatched transactions, counting its rows and time."""
+    metrics.inc("matcher_rows_in_total", len(unmatched), matcher=matcher)
+    with metrics.timer("matcher_seconds", matcher=matcher):
+        matches = match_function(unmatched, ref)
+    metrics.inc("matcher_rows_out_total", len(matches), matcher=matcher)
+    if not matches.empty:
+        logger.info(f"Found {len(matches)} {matcher} matches.")
+    return matches
 
-    addr_df = pd.read_sql(select(addresses), engine)
+def run_waterfall(txn_df, ref, strategies=DEFAULT_STRATEGIES, spatial=True):
+    """Run the strategies, the fallbacks, the token stage and, with spatial, the spatial stage; returns (matches, report)."""
     all_matches = []
     unmatched = txn_df.copy()
-    for match_strategy in ["exact", "fuzzy"]:
-        logger.info(f"Attempting {match_strategy} match...")
-        match_function = MATCHING_METHODS[match_strategy]
-        matches = match_function(unmatched, addr_df)
+    stages = [(match_strategy, MATCHING_METHODS[match_strategy]) for match_strategy in strategies]
+    stages.append(("fallback", run_fallbacks))
+    if TOKEN_TOP_K:
+        # last chance for the records whose blocking fields line up with no address
+        stages.append(("token", token_match))
+    if spatial and ref.grid is not None:
+        stages.append(("spatial", spatial_match))
+    for matcher, match_function in stages:
+        if unmatched.empty:
+            break
+        logger.info(f"Attempting {matcher} match...")
+        matches = run_matcher(matcher, match_function, unmatched, ref)
         if not matches.empty:
-            logger.info(f"Inserted {len(matches)} {match_strategy} matches into match_results.")
             all_matches.append(matches)
             unmatched = unmatched[~unmatched["id"].isin(matches["transaction_id"])]
-    if not unmatched.empty:
-        # Attempt fallbacks
-        fallback_matches = run_fallbacks(unmatched, addr_df)
-        if not fallback_matches.empty:
-            all_matches.append(fallback_matches)
-            unmatched = unmatched[~unmatched["id"].isin(fallback_matches["transaction_id"])]
-            logger.info(f"Inserted {len(fallback_matches)} fallback matches into match_results.")
-
-    if all_matches:
-        all_matches_df = pd.concat(all_matches, ignore_index=True)
-        all_matches_df.to_sql(match_results.name, engine, if_exists="append", index=False)
-        logger.info(f"Inserted {len(all_matches_df)} matches into match_results.")
-
-    if not unmatched.empty:
-        report = pd.DataFrame({
-            "transaction_id": unmatched.id,
-            "reason": "low fuzzy score",
-            "attempted_at": datetime.now().isoformat()
-        })
-        report.to_sql("unmatched_report", engine, if_exists="append", index=False)
 
-    return True
+    matches = pd.concat(all_matches, ignore_index=True) if all_matches else pd.DataFrame()
+    report = pd.DataFrame({
+        "transaction_id": unmatched.id,
+        "reason": UNMATCHED_REASON,
+        "attempted_at": datetime.now().isoformat()
+    })
+    return matches, report
+
+class KeyMemo:
+    """LRU of waterfall results by normalized key, kept across the batches of a run."""
+
+    def __init__(self, max_entries=config.pipeline.match_memo_size):
+        self.max_entries = max_entries
+        self.results = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.results
+
+    def get(self, key):
+        self.results.move_to_end(key)
+        return self.results[key]
+
+    def put(self, key, results):
+        self.results[key] = results
+        self.results.move_to_end(key)
+        if len(self.results) > self.max_entries:
+            self.results.popitem(last=False)
+
+def match_keys(txn_df):
+    """The normalized key of each transaction: every field a matcher other than spatial reads, with nulls as None."""
+    values = txn_df[EXACT_TXN_FIELDS].astype(object)
+    return list(values.where(values.notna(), None).itertuples(index=False, name=None))
+
+def match_transactions(txn_df, ref, strategies=DEFAULT_STRATEGIES, memo=None):
+    """Run the waterfall once per distinct key missing from memo, fan it out, then run the spatial stage per listing."""
+    if txn_df.empty:
+        return run_waterfall(txn_df, ref, strategies)
+    keys = match_keys(txn_df)
+    results = {}
+    pending = {}
+    for position, key in enumerate(keys):
+        if key in results or key in pending:
+            continue
+        if memo is not None and key in memo:
+            results[key] = memo.get(key)
+        else:
+            pending[key] = position
+    metrics.inc("match_keys_total", len(pending), source="matched")
+    metrics.inc("match_keys_total", len(results), source="memo")
+
+    if pending:
+        representatives = txn_df.iloc[list(pending.values())]
+        matches, _ = run_waterfall(representatives, ref, strategies, spatial=False)
+        key_of = dict(zip(representatives.id, pending))
+        results.update((key, []) for key in pending)
+        if not matches.empty:
+            for row in matches[["transaction_id", "address_id", "match_type", "confidence_score"]].itertuples(index=False):
+                results[key_of[row.transaction_id]].append(tuple(row[1:]))
+        if memo is not None:
+            for key in pending:
+                memo.put(key, results[key])
+
+    now = datetime.now().isoformat()
+    matched_rows = []
+    unmatched_ids = []
+    for transaction_id, key in zip(txn_df.id, keys):
+        key_results = results[key]
+        if not key_results:
+            unmatched_ids.append(transaction_id)
+        for address_id, match_type, confidence_score in key_results:
+            matched_rows.append((transaction_id, address_id, match_type, confidence_score, now))
+    if unmatched_ids and ref.grid is not None:
+        spatial_matches = run_matcher("spatial", spatial_match, txn_df[txn_df.id.isin(unmatched_ids)], ref)
+        if not spatial_matches.empty:
+            matched_rows.extend(
+                spatial_matches[["transaction_id", "address_id", "match_type", "confidence_score"]]
+                .assign(matched_at=now)
+                .itertuples(index=False, name=None)
+            )
+            spatial_ids = set(spatial_matches.transaction_id)
+            unmatched_ids = [transaction_id for transaction_id in unmatched_ids if transaction_id not in spatial_ids]
+    matches = pd.DataFrame(
+        matched_rows, columns=["transaction_id", "address_id", "match_type", "confidence_score", "matched_at"]
+    )
+    report = pd.DataFrame({
+        "transaction_id": unmatched_ids,
+        "reason": UNMATCHED_REASON,
+        "attempted_at": now
+    })
+    return matches, report
 
-def match_batch_test(offset=0) -> bool:
-    logger.info(f"[TEST] Matching batch at offset {offset}")
-    txn_df = fetch_unmatched_batch(offset)
+def unmatched_batches(pending_only=False, skip_matched=False, shard=None, shards=1, last_id=None):
+    """Yield parsed transactions after last_id batch by batch, paging by keyset until none are left."""
+    while True:
+        with metrics.timer("phase_seconds", stage="match", phase="fetch"):
+            txn_df = fetch_unmatched_batch(last_id, pending_only, skip_matched, shard, shards)
+        if txn_df.empty:
+            logger.info("No more unmatched transactions to process.")
+            return
+        logger.info(f"Matching batch after id {last_id}")
+        last_id = txn_df.id.iloc[-1]
+        yield txn_df
+
+def match_batch(txn_df, ref, strategies=DEFAULT_STRATEGIES, memo=None):
+    """Run the waterfall over one fetched batch and return (matches, report)."""
+    with metrics.timer("phase_seconds", stage="match", phase="compute"):
+        matches, report = match_transactions(txn_df, ref, strategies, memo)
+    metrics.inc("rows_in_total", len(txn_df), stage="match")
+    metrics.inc("rows_out_total", len(matches), stage="match")
+    return matches, report
+
+def match_batch_test(last_id=None, ref=None):
+    logger.info(f"[TEST] Matching batch after id {last_id}")
+    txn_df = fetch_unmatched_batch(last_id)
     logger.info(f"[TEST] Transactions fetched: {len(txn_df)}")
     if txn_df.empty:
         logger.info("[TEST] No transactions to test match on.")
         return
 
-    addr_df = pd.read_sql(select(addresses), engine)
+    if ref is None:
+        ref = ReferenceIndex.load(engine)
 
     logger.info(f"[TEST] Attempting exact match...")
-    exact = exact_match(txn_df, addr_df)
+    exact = exact_match(txn_df, ref)
     logger.info(f"[TEST] Exact matches: {len(exact)}")
     logger.info(f"[TEST] Unique transactions matched exactly: {exact['transaction_id'].nunique()}")
     if not exact.empty:
@@ -158,25 +608,158 @@ def match_batch_test(offset=0) -> bool:
     logger.info(f"[TEST] Unmatched remaining: {len(unmatched)}")
 
     logger.info(f"[TEST] Attempting fuzzy match...")
-    fuzzy = fuzzy_match(unmatched, addr_df)
+    fuzzy = fuzzy_match(unmatched, ref)
     logger.info(f"[TEST] Fuzzy matches: {len(fuzzy)}")
 
     unmatched = unmatched[~unmatched.id.isin(fuzzy.transaction_id)]
     logger.info(f"[TEST] Unmatched remaining: {len(unmatched)}")
 
     logger.info(f"[TEST] Attempting fallbacks...")
-    fallback = run_fallbacks(unmatched, addr_df)
+    fallback = run_fallbacks(unmatched, ref)
     logger.info(f"[TEST] Fallback matches: {len(fallback)}")
 
     unmatched = unmatched[~unmatched.id.isin(fallback.transaction_id)]
     logger.info(f"[TEST] Unmatched remaining: {len(unmatched)}")
 
-def run_match():
-    offset = 0
-    while match_batch(offset):
-        logger.info(f"Matching batch starting at offset {offset}")
-        offset += BATCH_SIZE
+def invalidate_changed_blocks():
+    """Drop the results of the transactions that addresses added or changed since the last match run could affect."""
+    with engine.begin() as conn:
+        watermark = int(get_state(conn, ADDRESS_CHANGES_KEY) or 0)
+        last_change = conn.execute(text("SELECT max(id) FROM ingest_changes")).scalar()
+        if last_change is None or last_change <= watermark:
+            return 0
+        conn.execute(
+            text(
+                "CREATE TEMP TABLE changed_addresses ON COMMIT DROP AS "
+                "SELECT DISTINCT record_id::integer AS id FROM ingest_changes "
+                "WHERE table_name = 'addresses' AND change_type IN ('insert', 'update') "
+                "AND id > :watermark AND id <= :last_change"
+            ),
+            {"watermark": watermark, "last_change": last_change},
+        )
+        affected = [
+            "SELECT t.id FROM transactions_parsed t JOIN addresses a ON a.house = t.street_number "
+            "WHERE a.id IN (SELECT id FROM changed_addresses)",
+            "SELECT transaction_id FROM match_results WHERE address_id IN (SELECT id FROM changed_addresses)",
+        ]
+        params = {"reason": UNMATCHED_REASON}
+        if TOKEN_TOP_K:
+            affected.append(SAME_STREET_AS_CHANGED_ADDRESSES_SQL)
+        if SPATIAL_RADIUS_M:
+            affected.append(NEAR_CHANGED_ADDRESSES_SQL)
+            params.update(
+                lat_radius=SPATIAL_RADIUS_M / METERS_PER_DEGREE_LAT,
+                lon_radius=SPATIAL_RADIUS_M / METERS_PER_DEGREE_LON,
+            )
+        conn.execute(text("CREATE TEMP TABLE rematch ON COMMIT DROP AS " + " UNION ".join(affected)), params)
+        rematched = conn.execute(text("SELECT count(*) FROM rematch")).scalar()
+        conn.execute(text("DELETE FROM match_results WHERE transaction_id IN (SELECT id FROM rematch)"))
+        conn.execute(
+            text("DELETE FROM unmatched_report WHERE reason = :reason AND transaction_id IN (SELECT id FROM rematch)"),
+            {"reason": UNMATCHED_REASON},
+        )
+        set_state(conn, ADDRESS_CHANGES_KEY, last_change)
+    logger.info(f"Reference changes up to {last_change} reopened {rematched} transactions for matching")
+    return rematched
+
+def batches_stage(shard=None, shards=1):
+    """run_ledger stage checkpointing the batches of the whole match, or of one shard."""
+    return "match.batches" if shard is None else f"match.batches.{shard}/{shards}"
+
+def match_all(ref, strategies, pending_only=False, run_id=None, pipelined=True, shard=None, shards=1, last_id=None):
+    """Match every pending batch (of one shard) after last_id against ref and write the results.
+
+    Each flush also checkpoints the last written batch in run_ledger.
+    """
+    stage = batches_stage(shard, shards)
+    writer = BufferedWriter(run_id=run_id, stage="match", ledger_stage=stage)
+    # without the in-memory exact stage, exact matches were already inserted by exact_match_in_db
+    skip_matched = "exact" not in strategies
+    # the reference does not change during a run, so neither do the results of a key
+    memo = KeyMemo()
+
+    def compute(txn_df):
+        return txn_df.id.iloc[-1], len(txn_df), match_batch(txn_df, ref, strategies, memo)
+
+    def write(result):
+        last_id, rows_in, (matches, report) = result
+        writer.add(match_results.name, matches)
+        writer.add(unmatched_report.name, report)
+        writer.checkpoint(last_id, rows_in)
+
+    run_batches(
+        unmatched_batches(pending_only, skip_matched, shard, shards, last_id),
+        compute,
+        write,
+        stage="match",
+        pipelined=pipelined,
+    )
+    writer.close()
+    finish_stage(run_id, stage)
+
+def match_batches(strategies, pending_only=False, run_id=None, pipelined=True, shard=None, shards=1):
+    """Load the reference (of one shard) and match the batches its ledger stage has not done yet."""
+    progress = begin_stage(run_id, batches_stage(shard, shards))
+    if progress["status"] == DONE:
+        return
+    with metrics.timer("phase_seconds", stage="match", phase="fetch"):
+        ref = ReferenceIndex.load(engine, shard, shards)
+    match_all(ref, strategies, pending_only, run_id, pipelined, shard, shards, progress["last_key"])
+
+def match_shard(shard, shards, strategies, pending_only=False, run_id=None, pipelined=True):
+    """Match one house number shard in a worker process and return its metrics for the parent to merge.
+
+    The worker loads only the addresses of its shard.
+    """
+    # pooled connections inherited from the parent process must not be reused here
+    engine.dispose(close=False)
+    metrics.reset()
+    match_batches(strategies, pending_only, run_id, pipelined, shard, shards)
+    return metrics.state()
+
+def clear_match_results(conn):
+    """Drop the results of earlier match runs, which a full run replaces."""
+    conn.execute(text("TRUNCATE match_results"))
+    conn.execute(text("DELETE FROM unmatched_report WHERE reason = :reason"), {"reason": UNMATCHED_REASON})
+
+def run_match(
+    mode=config.pipeline.match_mode,
+    exact_engine=config.pipeline.exact_engine,
+    fuzzy_strategy=config.pipeline.match_strategy,
+    run_id=None,
+    pipelined=config.pipeline.execution == "pipelined",
+    shards=config.pipeline.match_shards,
+):
+    """Match parsed transactions in checkpointed batches, "full" or "incremental", over shards processes."""
+    run_id = run_id or new_run_id()
+    logger.info(f"Matching run {run_id} ({mode})")
+    pending_only = mode == "incremental"
+    progress = begin_stage(run_id, MATCH_STAGE, on_start=None if pending_only else clear_match_results)
+    if progress["status"] == DONE:
+        return
+    if pending_only:
+        invalidate_changed_blocks()
+    strategies = ["exact", fuzzy_strategy]
+    if exact_engine == "sql":
+        # exact_match_in_db skips matched transactions, so repeating it after a crash is harmless
+        if begin_stage(run_id, EXACT_SQL_STAGE)["status"] != DONE:
+            finish_stage(run_id, EXACT_SQL_STAGE, rows_out=exact_match_in_db(pending_only, run_id))
+        strategies = [fuzzy_strategy]
+    if shards > 1:
+        logger.info(f"Matching in {shards} house number shards")
+        with ProcessPoolExecutor(max_workers=shards) as pool:
+            futures = [
+                pool.submit(match_shard, shard, shards, strategies, pending_only, run_id, pipelined)
+                for shard in range(shards)
+            ]
+            for future in futures:
+                metrics.merge(future.result())
+    else:
+        # load the reference once and reuse it for every batch
+        match_batches(strategies, pending_only, run_id, pipelined)
+    finish_stage(run_id, MATCH_STAGE)
 
 if __name__ == "__main__":
+    migrate()
     run_match()
     #match_batch_test()
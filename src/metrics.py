@@ -0,0 +1,177 @@
+from bisect import bisect_left
+from collections import defaultdict
+from config import config
+from contextlib import contextmanager
+import json
+import logging
+import os
+import threading
+import time
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+logger = logging.getLogger(__name__)
+
+# upper bounds of the candidate block size histogram buckets; +Inf is implied
+BLOCK_SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+class Metrics:
+    """In-process counters, timers and histograms, written out once at the end of a run.
+
+    Every metric is keyed by its name and a set of labels. Updating one is a
+    dict lookup and an addition, so hot paths can count per row or per block
+    instead of logging. Updates take a lock, so reader and writer threads
+    can share the registry. Timers keep a count, a sum and a max of seconds.
+    Histograms count per bucket; the Prometheus export makes them cumulative.
+    """
+
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.timers = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] += value
+
+    def observe_time(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            timer = self.timers.setdefault(key, [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_time(name, time.perf_counter() - start, **labels)
+
+    def observe(self, name, value, count=1, buckets=BLOCK_SIZE_BUCKETS, **labels):
+        """Record value count times, e.g. one block size for every transaction scored against it."""
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {"buckets": buckets, "counts": [0] * (len(buckets) + 1), "sum": 0.0, "count": 0}
+            histogram["counts"][bisect_left(buckets, value)] += count
+            histogram["sum"] += value * count
+            histogram["count"] += count
+
+    def reset(self):
+        self.__init__()
+
+    def state(self):
+        """A plain copy of every metric, e.g. to send a worker process's metrics back to the parent."""
+        with self.lock:
+            return (
+                dict(self.counters),
+                {key: list(timer) for key, timer in self.timers.items()},
+                {key: {**h, "counts": list(h["counts"])} for key, h in self.histograms.items()},
+            )
+
+    def merge(self, state):
+        """Add a state() taken in another process."""
+        counters, timers, histograms = state
+        with self.lock:
+            for key, value in counters.items():
+                self.counters[key] += value
+            for key, (count, total, longest) in timers.items():
+                timer = self.timers.setdefault(key, [0, 0.0, 0.0])
+                timer[0] += count
+                timer[1] += total
+                timer[2] = max(timer[2], longest)
+            for key, h in histograms.items():
+                mine = self.histograms.setdefault(
+                    key, {"buckets": h["buckets"], "counts": [0] * len(h["counts"]), "sum": 0.0, "count": 0}
+                )
+                mine["counts"] = [a + b for a, b in zip(mine["counts"], h["counts"])]
+                mine["sum"] += h["sum"]
+                mine["count"] += h["count"]
+
+    def to_json(self):
+        def entry(key, **values):
+            return {"name": key[0], "labels": dict(key[1]), **values}
+
+        return {
+            "counters": [entry(key, value=value) for key, value in sorted(self.counters.items())],
+            "timers": [
+                entry(key, count=count, seconds=round(total, 6), max_seconds=round(longest, 6))
+                for key, (count, total, longest) in sorted(self.timers.items())
+            ],
+            "histograms": [
+                entry(
+                    key,
+                    buckets={str(bound): n for bound, n in zip((*h["buckets"], "+Inf"), h["counts"])},
+                    sum=h["sum"],
+                    count=h["count"],
+                )
+                for key, h in sorted(self.histograms.items())
+            ],
+        }
+
+    def to_prometheus(self):
+        """The metrics in the Prometheus text format, e.g. for the node_exporter textfile collector."""
+        def series(name, labels, value, extra=()):
+            pairs = [*labels, *extra]
+            label_text = "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}" if pairs else ""
+            return f"{name}{label_text} {value}"
+
+        lines = []
+        declared = set()
+
+        def declare(name, kind):
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(self.counters.items()):
+            declare(name, "counter")
+            lines.append(series(name, labels, value))
+        for (name, labels), (count, total, longest) in sorted(self.timers.items()):
+            declare(name, "summary")
+            lines.append(series(f"{name}_count", labels, count))
+            lines.append(series(f"{name}_sum", labels, total))
+        for (name, labels), (count, total, longest) in sorted(self.timers.items()):
+            declare(f"{name}_max", "gauge")
+            lines.append(series(f"{name}_max", labels, longest))
+        for (name, labels), h in sorted(self.histograms.items()):
+            declare(name, "histogram")
+            cumulative = 0
+            for bound, n in zip((*h["buckets"], "+Inf"), h["counts"]):
+                cumulative += n
+                lines.append(series(f"{name}_bucket", labels, cumulative, extra=[("le", bound)]))
+            lines.append(series(f"{name}_sum", labels, h["sum"]))
+            lines.append(series(f"{name}_count", labels, h["count"]))
+        return "\n".join(lines) + "\n"
+
+    def phase_shares(self):
+        """Share of the phase_seconds total spent fetching, computing and writing, over all stages."""
+        totals = defaultdict(float)
+        for (name, labels), (_, seconds, _) in self.timers.items():
+            if name == "phase_seconds":
+                totals[dict(labels)["phase"]] += seconds
+        overall = sum(totals.values())
+        return {phase: seconds / overall for phase, seconds in totals.items()} if overall else {}
+
+    def write(self, path=config.metrics.path, format=config.metrics.format):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            if format == "prometheus":
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.to_json(), f, indent=2)
+        shares = ", ".join(f"{phase} {share:.0%}" for phase, share in sorted(self.phase_shares().items()))
+        logger.info(f"Wrote metrics to {path}" + (f" (time split: {shares})" if shares else ""))
+        return path
+
+# shared by every module of the process
+metrics = Metrics()
@@ -1,4 +1,6 @@
 from exception import NormalizationError
+from metaphone import doublemetaphone
+import pandas as pd
 import re
 
 # USPS Publication 28 - Secondary Unit Designators
@@ -69,3 +71,10 @@ def normalize_tagged_address(tagged):
         "state": clean(tagged.get("StateName")),
         "zip": tagged.get("ZipCode")
     }
+
+def phonetic_keys(street):
+    """Primary and secondary double metaphone codes of a street name, None where there is no code."""
+    if pd.isna(street) or not str(street).strip():
+        return None, None
+    primary, secondary = doublemetaphone(str(street))
+    return primary or None, secondary or None
@@ -1,11 +1,20 @@
+from batches import run_batches
+from concurrent.futures import ProcessPoolExecutor
 from config import config
 from datetime import datetime
-from db import get_connection
+from db import get_connection, migrate, new_run_id
 from exception import InvalidAddressTypeError
+from fast_parse import fast_tag
+from ledger import begin_stage, finish_stage, DONE
+from metrics import metrics
 from normalize import normalize_tagged_address, NormalizationError
+from parse_cache import ParseCache
 from schema import transactions_raw, transactions_parsed, unmatched_report
-from sqlalchemy import select
+from sqlalchemy import exists, select, text
+from writer import BufferedWriter
 import logging
+import math
+import os
 import pandas as pd
 import usaddress
 
@@ -15,6 +24,10 @@ logger = logging.getLogger(__name__)
 engine = get_connection()
 
 STREET_ADDRESS_TYPE = "Street Address"
+# parse failures are the unmatched_report rows of transactions without a parsed row; a fresh parse run retries them
+CLEAR_PARSE_FAILURES_SQL = (
+    "DELETE FROM unmatched_report u WHERE NOT EXISTS (SELECT 1 FROM transactions_parsed p WHERE p.id = u.transaction_id)"
+)
 
 def postprocess_place_name(tagged):
     """Fix PlaceName that includes unit info like 'Unit PHA, Brooklyn'."""
@@ -27,71 +40,248 @@ def postprocess_place_name(tagged):
             tagged["PlaceName"] = city_part
     return tagged
 
-def normalize_and_parse(batch_size=config.pipeline.batch_size):
-    offset = 0
-    total_inserted = 0
+PARSE_ERRORS = (
+    usaddress.RepeatedLabelError,
+    InvalidAddressTypeError,
+    NormalizationError
+)
+
+# Parse failure reasons quote the address or the offending value. Metrics count them by these prefixes.
+FAILURE_KINDS = [
+    ("Invalid address type", "invalid_address_type"),
+    ("Unknown value", "normalization"),
+    ("ERROR: Unable to tag", "repeated_label"),
+]
+
+def failure_kind(reason):
+    """Short, low-cardinality label for a parse failure reason."""
+    reason = reason.strip()
+    for prefix, kind in FAILURE_KINDS:
+        if reason.startswith(prefix):
+            return kind
+    return "other"
+
+def assemble_address(row):
+    line_2 = row["address_line_2"]
+    return (
+        f"{row['address_line_1']}"
+        f"{', ' + line_2 if pd.notna(line_2) and line_2 else ''}, "
+        f"{row['city']} {row['state']} {row['zip_code']}"
+    )
+
+def parse_address(address, fast=config.pipeline.fast_parse):
+    """Tag, fix up and normalize one assembled address. Raises one of PARSE_ERRORS on failure.
+
+    With fast, the regular shapes are tagged by fast_tag and only the rest
+    by the usaddress CRF.
+    """
+    tagged = fast_tag(address) if fast else None
+    if tagged is None:
+        tagged, address_type = usaddress.tag(address)
+        if address_type != STREET_ADDRESS_TYPE:
+            raise InvalidAddressTypeError("Invalid address type")
+        tagged = postprocess_place_name(tagged)
+    return normalize_tagged_address(tagged)
+
+def parse_records(records):
+    """Parse raw transaction records with usaddress into (parsed rows, unmatched_report records)."""
+    parsed_rows = []
+    unmatched_records = []
+    for row in records:
+        address = assemble_address(row)
+        try:
+            normalized = parse_address(address, fast=False)
+            normalized["id"] = row["id"]
+            parsed_rows.append(normalized)
+        except PARSE_ERRORS as e:
+            logger.debug("Could not parse address %s: %s", address, e)
+            unmatched_records.append({
+                "transaction_id": row["id"],
+                "reason": str(e),
+                "attempted_at": datetime.now().isoformat()
+            })
+    return parsed_rows, unmatched_records
+
+def fast_parse_records(records):
+    """Split records into rows parsed by fast_tag and the records left for usaddress."""
+    parsed_rows = []
+    remaining = []
+    for row in records:
+        tagged = fast_tag(assemble_address(row))
+        if tagged is None:
+            remaining.append(row)
+        else:
+            parsed_rows.append({**normalize_tagged_address(tagged), "id": row["id"]})
+    metrics.inc("parse_fast_path_total", len(parsed_rows), result="hit")
+    metrics.inc("parse_fast_path_total", len(remaining), result="miss")
+    return parsed_rows, remaining
+
+def chunk_records(records, chunk_size, workers):
+    """Split records into chunks of at most chunk_size rows, and small enough that every worker gets one."""
+    size = max(1, min(chunk_size, math.ceil(len(records) / workers)))
+    return [records[i:i + size] for i in range(0, len(records), size)]
+
+def parse_all(records, pool=None, workers=1, chunk_size=config.pipeline.parse_chunk_size, fast=config.pipeline.fast_parse):
+    """Parse records in-process, or spread them over a pool of workers processes in chunks of up to chunk_size rows.
+
+    With fast, the fast path runs here first and only its misses go to
+    usaddress, so the pool is not sent the easy rows at all.
+    """
+    parsed_rows = []
+    if fast:
+        parsed_rows, records = fast_parse_records(records)
+    if pool is None:
+        usaddress_rows, unmatched_records = parse_records(records)
+        return parsed_rows + usaddress_rows, unmatched_records
     unmatched_records = []
+    for chunk_parsed, chunk_unmatched in pool.map(parse_records, chunk_records(records, chunk_size, workers)):
+        parsed_rows.extend(chunk_parsed)
+        unmatched_records.extend(chunk_unmatched)
+    return parsed_rows, unmatched_records
 
-    while True:
-        statement = (
-            select(
-                transactions_raw.c.id,
-                transactions_raw.c.address_line_1,
-                transactions_raw.c.address_line_2,
-                transactions_raw.c.city,
-                transactions_raw.c.state,
-                transactions_raw.c.zip_code,
-            )
-            # skip already parsed transactions
-            .where(~transactions_raw.c.id.in_(select(transactions_parsed.c.id)))
-            .limit(batch_size)
-            .offset(offset)
+def parse_batch(df, pool=None, cache=None, workers=1, chunk_size=config.pipeline.parse_chunk_size):
+    """Parse a batch of raw rows, tagging each distinct uncached address only once."""
+    records = df.to_dict("records")
+    if cache is None:
+        return parse_all(records, pool, workers, chunk_size)
+
+    addresses = [assemble_address(row) for row in records]
+    cached = cache.get_many(addresses)
+    pending = {}
+    for address, row in zip(addresses, records):
+        if address not in cached and address not in pending:
+            pending[address] = row
+
+    parsed_rows, unmatched_records = parse_all(list(pending.values()), pool, workers, chunk_size)
+    address_of = {row["id"]: address for address, row in pending.items()}
+    fresh = {}
+    for row in parsed_rows:
+        fresh[address_of[row["id"]]] = ("ok", {k: v for k, v in row.items() if k != "id"})
+    for record in unmatched_records:
+        fresh[address_of[record["transaction_id"]]] = ("error", record["reason"])
+    cache.put_many(fresh)
+    cached.update(fresh)
+
+    parsed_rows = []
+    unmatched_records = []
+    attempted_at = datetime.now().isoformat()
+    for address, row in zip(addresses, records):
+        status, value = cached[address]
+        if status == "ok":
+            parsed_rows.append({**value, "id": row["id"]})
+        else:
+            unmatched_records.append({
+                "transaction_id": row["id"],
+                "reason": value,
+                "attempted_at": attempted_at
+            })
+    return parsed_rows, unmatched_records
+
+def record_parse_metrics(rows_in, parsed_rows, unmatched_records, cache=None):
+    """Count one parsed batch: rows in and out, failures by kind and parse cache hits, which are also logged."""
+    metrics.inc("rows_in_total", rows_in, stage="parse")
+    metrics.inc("rows_out_total", len(parsed_rows), stage="parse")
+    for record in unmatched_records:
+        metrics.inc("parse_failures_total", kind=failure_kind(record["reason"]))
+    if cache is not None:
+        hits, misses = cache.reset_stats()
+        metrics.inc("parse_cache_hits_total", hits)
+        metrics.inc("parse_cache_misses_total", misses)
+        logger.info(f"Parse cache: {hits} hits, {misses} misses")
+
+def parse_workers(workers=config.pipeline.parse_workers):
+    """Number of parse processes for the workers setting, where 0 means every core."""
+    return workers or os.cpu_count()
+
+def make_parse_pool(workers=config.pipeline.parse_workers):
+    """Process pool for parse_batch, or None to parse in-process. workers=0 uses every core."""
+    workers = parse_workers(workers)
+    if workers <= 1:
+        return None
+    logger.info(f"Parsing with {workers} worker processes")
+    return ProcessPoolExecutor(max_workers=workers)
+
+def fetch_raw_batch(last_id=None, batch_size=config.pipeline.batch_size):
+    """Next batch of unparsed raw transactions after last_id, by keyset on the primary key."""
+    statement = (
+        select(
+            transactions_raw.c.id,
+            transactions_raw.c.address_line_1,
+            transactions_raw.c.address_line_2,
+            transactions_raw.c.city,
+            transactions_raw.c.state,
+            transactions_raw.c.zip_code,
         )
-        df = pd.read_sql(statement, engine)
+        # skip already parsed transactions
+        .where(~exists().where(transactions_parsed.c.id == transactions_raw.c.id))
+        .order_by(transactions_raw.c.id)
+        .limit(batch_size)
+    )
+    if last_id is not None:
+        statement = statement.where(transactions_raw.c.id > last_id)
+    return pd.read_sql(statement, engine)
+
+def raw_batches(batch_size=config.pipeline.batch_size, last_id=None):
+    """Yield unparsed raw transactions after last_id batch by batch, paging by keyset until none are left."""
+    while True:
+        with metrics.timer("phase_seconds", stage="parse", phase="fetch"):
+            df = fetch_raw_batch(last_id, batch_size)
         if df.empty:
-            break
-        logger.info(f"Processing batch with offset {offset} and size {len(df)}")
-
-        parsed_rows = []
-        for _, row in df.iterrows():
-            address = (
-                f"{row['address_line_1']}"
-                f"{', ' + row['address_line_2'] if row['address_line_2'] else ''}, "
-                f"{row['city']} {row['state']} {row['zip_code']}"
-            )
-            try:
-                tagged, address_type = usaddress.tag(address)
-                if address_type != STREET_ADDRESS_TYPE:
-                    raise InvalidAddressTypeError("Invalid address type")
-                tagged = postprocess_place_name(tagged)
-                normalized = normalize_tagged_address(tagged)
-                normalized["id"] = row["id"]
-                parsed_rows.append(normalized)
-            except (
-                usaddress.RepeatedLabelError,
-                InvalidAddressTypeError,
-                NormalizationError
-            ) as e:
-                logger.warning(f"Could not parse address {address}: {e}")
-                unmatched_records.append({
-                    "transaction_id": row["id"],
-                    "reason": str(e),
-                    "attempted_at": datetime.now().isoformat()
-                })
-
-        if parsed_rows:
-            parsed_df = pd.DataFrame(parsed_rows)
-            parsed_df.to_sql("transactions_parsed", engine, if_exists="append", index=False)
-            total_inserted += len(parsed_df)
-            logger.info(f"Inserted {len(parsed_df)} rows into transactions_parsed")
-
-        if unmatched_records:
-            unmatched_df = pd.DataFrame(unmatched_records)
-            unmatched_df.to_sql("unmatched_report", engine, if_exists="append", index=False)
-            logger.info(f"Inserted {len(unmatched_df)} rows into unmatched_report")
-            unmatched_records.clear()
-
-        offset += batch_size
+            return
+        logger.info(f"Processing batch after id {last_id} with size {len(df)}")
+        last_id = df.id.iloc[-1]
+        yield df
+
+def normalize_and_parse(
+    batch_size=config.pipeline.batch_size,
+    workers=config.pipeline.parse_workers,
+    run_id=None,
+    pipelined=config.pipeline.execution == "pipelined",
+    cache_path=config.cache.parse_path,
+):
+    """Parse every unparsed raw transaction into transactions_parsed, or unmatched_report on failure.
+
+    Pipelined, the next batches are fetched and the previous results are
+    written while a batch is being parsed. Progress is checkpointed in
+    run_ledger, so calling this again with the run_id of an interrupted run
+    continues after its last committed batch. A fresh run first drops the
+    earlier parse failures, since it parses those transactions again.
+    cache_path=None keeps the parse cache in memory for this run only.
+    """
+    run_id = run_id or new_run_id()
+    progress = begin_stage(run_id, "parse", on_start=lambda conn: conn.execute(text(CLEAR_PARSE_FAILURES_SQL)))
+    if progress["status"] == DONE:
+        return
+    total_inserted = 0
+    workers = parse_workers(workers)
+    pool = make_parse_pool(workers)
+    cache = ParseCache(path=cache_path) if config.cache.parse_enabled else None
+    writer = BufferedWriter(run_id=run_id, stage="parse", ledger_stage="parse")
+
+    def compute(df):
+        with metrics.timer("phase_seconds", stage="parse", phase="compute"):
+            parsed_rows, unmatched_records = parse_batch(df, pool, cache, workers)
+        record_parse_metrics(len(df), parsed_rows, unmatched_records, cache)
+        logger.info(f"Parsed {len(parsed_rows)} rows, {len(unmatched_records)} failed")
+        return df.id.iloc[-1], len(df), parsed_rows, unmatched_records
+
+    def write(result):
+        nonlocal total_inserted
+        last_id, rows_in, parsed_rows, unmatched_records = result
+        writer.add(transactions_parsed.name, parsed_rows)
+        writer.add(unmatched_report.name, unmatched_records)
+        writer.checkpoint(last_id, rows_in)
+        total_inserted += len(parsed_rows)
+
+    try:
+        run_batches(raw_batches(batch_size, progress["last_key"]), compute, write, stage="parse", pipelined=pipelined)
+        writer.close()
+        finish_stage(run_id, "parse")
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        if cache is not None:
+            cache.close()
 
     logger.info(f"Total inserted rows: {total_inserted} in transactions_parsed")
 
@@ -143,5 +333,6 @@ def test_sample_parsing(sample_size=300):
         logger.warning(f"Could not parse transaction {r['transaction_id']} - address {r['address']}: {r['reason']}")
 
 if __name__ == "__main__":
+    migrate()
     normalize_and_parse()
     #test_sample_parsing()
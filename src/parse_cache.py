@@ -0,0 +1,100 @@
+from collections import OrderedDict
+from config import config
+from importlib.metadata import version as package_version
+import json
+import logging
+import os
+import sqlite3
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+logger = logging.getLogger(__name__)
+
+# Bump when parse_address or normalize_tagged_address change their output so stale entries are ignored.
+NORMALIZER_VERSION = "1"
+# the fast path tags a few shapes differently from usaddress, so its entries are kept apart
+PARSER_VERSION = (
+    f"usaddress-{package_version('usaddress')}/normalize-{NORMALIZER_VERSION}"
+    + ("/fast" if config.pipeline.fast_parse else "")
+)
+
+class ParseCache:
+    """Two-tier cache from an assembled address string to its parse outcome.
+
+    An in-process LRU sits in front of an SQLite file, so that duplicate
+    addresses within a run and across runs skip usaddress. An entry is either
+    ("ok", normalized dict) or ("error", failure reason). Entries are keyed
+    together with PARSER_VERSION.
+    """
+
+    def __init__(self, path=config.cache.parse_path, max_entries=config.cache.parse_lru_size, version=PARSER_VERSION):
+        self.version = version
+        self.max_entries = max_entries
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.db = None
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self.db = sqlite3.connect(path)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS parse_cache ("
+                "address TEXT, version TEXT, status TEXT, payload TEXT, "
+                "PRIMARY KEY (address, version))"
+            )
+
+    def _remember(self, address, entry):
+        self.memory[address] = entry
+        self.memory.move_to_end(address)
+        if len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def get_many(self, addresses):
+        """Return {address: (status, value)} for every cached address and count hits and misses."""
+        found = {}
+        missing = []
+        for address in set(addresses):
+            if address in self.memory:
+                self.memory.move_to_end(address)
+                found[address] = self.memory[address]
+            else:
+                missing.append(address)
+        if self.db is not None and missing:
+            for i in range(0, len(missing), 500):
+                chunk = missing[i:i + 500]
+                rows = self.db.execute(
+                    f"SELECT address, status, payload FROM parse_cache "
+                    f"WHERE version = ? AND address IN ({','.join('?' * len(chunk))})",
+                    [self.version, *chunk],
+                )
+                for address, status, payload in rows:
+                    entry = (status, json.loads(payload))
+                    found[address] = entry
+                    self._remember(address, entry)
+        for address in addresses:
+            if address in found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return found
+
+    def put_many(self, entries):
+        """Store {address: (status, value)} in both tiers."""
+        for address, entry in entries.items():
+            self._remember(address, entry)
+        if self.db is not None and entries:
+            with self.db:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO parse_cache (address, version, status, payload) VALUES (?, ?, ?, ?)",
+                    [(address, self.version, status, json.dumps(value)) for address, (status, value) in entries.items()],
+                )
+
+    def reset_stats(self):
+        hits, misses = self.hits, self.misses
+        self.hits = 0
+        self.misses = 0
+        return hits, misses
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
@@ -0,0 +1,367 @@
+from collections import defaultdict
+from config import config
+from functools import cached_property
+from normalize import phonetic_keys
+from schema import addresses
+from sqlalchemy import bindparam, func, or_, select, update
+import logging
+import numpy as np
+import pandas as pd
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+logger = logging.getLogger(__name__)
+
+# blocking keys used by the matchers
+FUZZY_BLOCK_KEY = ["zip", "house", "city"]
+PHONETIC_CODE_COLUMNS = ["street_metaphone", "street_metaphone_alt"]
+# transactions_parsed fields and the addresses columns they must equal for an exact match
+EXACT_TXN_FIELDS = ["street_number", "street_name", "street_type", "unit_type", "unit_identifier", "city", "state", "zip"]
+EXACT_ADDR_FIELDS = ["house", "street", "strtype", "apttype", "aptnbr", "city", "state", "zip"]
+COORDINATE_COLUMNS = ["latitude", "longitude"]
+# the only addresses columns the matchers read; names and household ids are never loaded
+REFERENCE_COLUMNS = ["id", *EXACT_ADDR_FIELDS, *PHONETIC_CODE_COLUMNS, *COORDINATE_COLUMNS]
+# held as categoricals: every distinct value is stored once and each row keeps a small integer code
+CATEGORICAL_COLUMNS = EXACT_ADDR_FIELDS
+# coordinates are rounded to about a meter, so that the spatial candidates of a match key do not depend on jitter below that
+COORDINATE_DECIMALS = 5
+# meters per degree of latitude, and of longitude at the equator
+METERS_PER_DEGREE_LAT = 110540
+METERS_PER_DEGREE_LON = 111320
+# fields tokenized by the token index; the city is left out, so that aliases such as BROOKLYN and NEW YORK do not matter
+TOKEN_FIELDS = ["house", "street", "unit", "zip"]
+# indexed together as one term too; rare enough to propose candidates even where each field alone is common
+TOKEN_PAIRS = [("house", "street"), ("house", "zip"), ("street", "zip")]
+
+def street_keys(street, street_type):
+    """Vectorized "street strtype" strings compared by the fuzzy scorer."""
+    return (street.fillna("").astype(str) + " " + street_type.fillna("").astype(str)).str.strip()
+
+def street_key(street, street_type):
+    """Scalar version of street_keys."""
+    street = "" if pd.isna(street) else str(street)
+    street_type = "" if pd.isna(street_type) else str(street_type)
+    return f"{street} {street_type}".strip()
+
+def shard_condition(house_column, shard, shards, include_null=False):
+    """SQL condition selecting the rows whose house number hashes to shard; with include_null, shard 0 also gets rows without one."""
+    condition = (func.hashtext(house_column).op("&")(0x7FFFFFFF) % shards) == shard
+    if include_null and shard == 0:
+        condition = or_(condition, house_column.is_(None))
+    return condition
+
+def interned(values):
+    """values as an object array in which equal strings are one shared object."""
+    codes, uniques = pd.factorize(values, use_na_sentinel=False)
+    return np.asarray(uniques, dtype=object)[codes]
+
+def compact_reference(df):
+    """Only REFERENCE_COLUMNS, with categorical text columns and int32 ids (addresses.id is a SERIAL)."""
+    df = df[[column for column in REFERENCE_COLUMNS if column in df]]
+    return df.astype({"id": np.int32, **{column: "category" for column in CATEGORICAL_COLUMNS}})
+
+def rounded_coordinates(df):
+    """(latitude, longitude) arrays rounded to COORDINATE_DECIMALS, NaN where missing."""
+    return tuple(
+        np.round(pd.to_numeric(df[column], errors="coerce").to_numpy(dtype=np.float64), COORDINATE_DECIMALS)
+        for column in COORDINATE_COLUMNS
+    )
+
+class GridIndex:
+    """Grid hash over coordinates, answering "which points are within radius_m of here".
+
+    Cells are at least radius_m wide, so the answer always lies in the 3x3
+    cells around the query point, and a lookup costs nine dict accesses and
+    a distance check over the points found there. Distances use the
+    equirectangular approximation, which is accurate at these ranges.
+    """
+
+    def __init__(self, latitudes, longitudes, radius_m):
+        self.radius_m = radius_m
+        known = ~(np.isnan(latitudes) | np.isnan(longitudes))
+        self.latitudes = latitudes.astype(np.float32)
+        self.longitudes = longitudes.astype(np.float32)
+        max_latitude = np.abs(latitudes[known]).max() if known.any() else 0.0
+        self.lat_step = radius_m / METERS_PER_DEGREE_LAT
+        # a degree of longitude is shortest at the highest latitude, so size the cells for it
+        self.lon_step = radius_m / (METERS_PER_DEGREE_LON * max(np.cos(np.radians(max_latitude)), 1e-6))
+        cells = pd.DataFrame({
+            "row": np.floor(latitudes / self.lat_step),
+            "col": np.floor(longitudes / self.lon_step),
+        })[known]
+        self.cells = {
+            (int(row), int(col)): np.flatnonzero(known)[positions]
+            for (row, col), positions in build_blocks(cells.reset_index(drop=True), ["row", "col"]).items()
+        }
+
+    def near(self, latitude, longitude):
+        """Positions within radius_m of the point, nearest first."""
+        row = int(np.floor(latitude / self.lat_step))
+        col = int(np.floor(longitude / self.lon_step))
+        found = [
+            self.cells[(row + i, col + j)]
+            for i in (-1, 0, 1)
+            for j in (-1, 0, 1)
+            if (row + i, col + j) in self.cells
+        ]
+        if not found:
+            return np.empty(0, dtype=np.intp)
+        positions = np.concatenate(found)
+        dy = (self.latitudes[positions] - latitude) * METERS_PER_DEGREE_LAT
+        dx = (self.longitudes[positions] - longitude) * METERS_PER_DEGREE_LON * np.cos(np.radians(latitude))
+        distances = np.hypot(dx, dy)
+        within = distances <= self.radius_m
+        return positions[within][np.argsort(distances[within], kind="stable")]
+
+def field_tokens(field, value):
+    """Token index terms of one field value, prefixed with the field name.
+
+    The whole value is a term. The street key adds its padded 3-grams and
+    the house number its 2-grams, so that a misspelled street or a
+    transposed number still shares most terms with the address.
+    """
+    if value is None or pd.isna(value) or value == "":
+        return []
+    value = str(value)
+    tokens = [f"{field}:{value}"]
+    if field == "street":
+        padded = f" {value} "
+        tokens += dict.fromkeys(f"s:{padded[i:i + 3]}" for i in range(len(padded) - 2))
+    elif field == "house":
+        tokens += dict.fromkeys(f"h:{value[i:i + 2]}" for i in range(len(value) - 1))
+    return tokens
+
+def pair_field(first, second):
+    return f"{first}+{second}"
+
+def address_tokens(house, street, unit, zip_code):
+    """field_tokens of every TOKEN_FIELDS value of one address, and of its TOKEN_PAIRS."""
+    values = dict(zip(TOKEN_FIELDS, (house, street, unit, zip_code)))
+    tokens = [token for field, value in values.items() for token in field_tokens(field, value)]
+    for first, second in TOKEN_PAIRS:
+        if not any(values[field] is None or pd.isna(values[field]) or values[field] == "" for field in (first, second)):
+            tokens += field_tokens(pair_field(first, second), f"{values[first]}|{values[second]}")
+    return tokens
+
+def token_fields(house, street, unit, zip_code):
+    """Vectorized counterpart of address_tokens: the TokenIndex fields of many addresses."""
+    values = {
+        field: pd.Series(column, dtype=object).replace("", None)
+        for field, column in zip(TOKEN_FIELDS, (house, street, unit, zip_code))
+    }
+    fields = {field: column.to_numpy(dtype=object) for field, column in values.items()}
+    for first, second in TOKEN_PAIRS:
+        # NaN where either part is missing
+        fields[pair_field(first, second)] = (values[first] + "|" + values[second]).to_numpy(dtype=object)
+    return fields
+
+class TokenIndex:
+    """Inverted index from field_tokens terms to the row positions that contain them.
+
+    Postings of every term are slices of one int32 array sorted by term,
+    then row. Each distinct field value is tokenized once, however many
+    rows share it. A query ranks rows by the summed idf of the terms they
+    share with it. Only the terms in at most max_postings rows propose
+    candidates; more common ones only add their idf to the candidates, by
+    binary search in their postings. The pair terms are rare, so a record
+    with one wrong field still finds its address, and the cost of a query
+    depends on how common its terms are, not on the number of rows.
+    """
+
+    def __init__(self, fields, max_postings):
+        self.max_postings = max_postings
+        self.vocabulary = {}
+        size = len(next(iter(fields.values())))
+        terms, rows = [], []
+        for field, values in fields.items():
+            codes, uniques = pd.factorize(values)
+            order = np.argsort(codes, kind="stable").astype(np.int32)
+            counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+            # rows of value u are order[starts[u]:starts[u] + counts[u]], after the rows of missing values
+            starts = np.cumsum(counts) - counts + (codes < 0).sum()
+            pair_values, pair_terms = [], []
+            for u, value in enumerate(uniques):
+                for token in field_tokens(field, value):
+                    pair_values.append(u)
+                    pair_terms.append(self.vocabulary.setdefault(token, len(self.vocabulary)))
+            pair_values = np.asarray(pair_values, dtype=np.int64)
+            lengths = counts[pair_values]
+            # one (term, row) pair for every row of every (value, term) pair
+            offsets = np.repeat(starts[pair_values] - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+            terms.append(np.repeat(np.asarray(pair_terms, dtype=np.int32), lengths))
+            rows.append(order[offsets])
+        # one sort of term * size + row orders by term, then row, much faster than lexsort
+        keys = np.sort(np.concatenate(terms).astype(np.int64) * size + np.concatenate(rows))
+        self.postings = (keys % size).astype(np.int32)
+        self.bounds = np.searchsorted(keys, np.arange(len(self.vocabulary) + 1, dtype=np.int64) * size)
+        self.idf = np.log((size + 1) / (np.diff(self.bounds) + 1))
+
+    def top_k(self, tokens, k):
+        """Row positions sharing the most idf-weighted terms with tokens, best first, at most k."""
+        term_ids = [self.vocabulary[token] for token in dict.fromkeys(tokens) if token in self.vocabulary]
+        rare = [term for term in term_ids if self.bounds[term + 1] - self.bounds[term] <= self.max_postings]
+        if not rare:
+            return np.empty(0, dtype=np.int32)
+        found = [self.postings[self.bounds[term]:self.bounds[term + 1]] for term in rare]
+        weights = [np.full(len(positions), self.idf[term]) for term, positions in zip(rare, found)]
+        positions, inverse = np.unique(np.concatenate(found), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(weights))
+        for term in term_ids:
+            posting = self.postings[self.bounds[term]:self.bounds[term + 1]]
+            if len(posting) > self.max_postings:
+                at = np.minimum(np.searchsorted(posting, positions), len(posting) - 1)
+                scores += self.idf[term] * (posting[at] == positions)
+        # ties keep reference order, also at the k cut
+        return positions[np.lexsort((positions, -scores))[:k]]
+
+def build_blocks(df, columns):
+    """Map each blocking key to the row positions in df that share it, in reference order.
+
+    Rows with a null key part are skipped. Rows are numbered by group and
+    split after one stable sort, which is much faster than
+    DataFrameGroupBy.indices when there are hundreds of thousands of keys.
+    """
+    group = df.groupby(columns, sort=False, dropna=True, observed=True).ngroup().to_numpy()
+    order = np.argsort(group, kind="stable").astype(np.int32)
+    order = order[group[order] >= 0]
+    if not len(order):
+        return {}
+    starts = np.r_[0, np.flatnonzero(np.diff(group[order])) + 1]
+    ends = np.r_[starts[1:], len(order)]
+    key_columns = [df[column].to_numpy(dtype=object)[order[starts]] for column in columns]
+    keys = zip(*key_columns) if len(columns) > 1 else key_columns[0]
+    return {key: order[start:end] for key, start, end in zip(keys, starts.tolist(), ends.tolist())}
+
+def build_phonetic_blocks(df):
+    """Map (house, metaphone code) to row positions, indexing both the primary and the secondary code."""
+    blocks = {}
+    for column in PHONETIC_CODE_COLUMNS:
+        for key, positions in build_blocks(df, ["house", column]).items():
+            blocks[key] = positions if key not in blocks else np.union1d(blocks[key], positions)
+    return blocks
+
+def fill_phonetic_keys(df):
+    """Compute metaphone codes for rows loaded without them, e.g. addresses ingested before the columns existed."""
+    for column in PHONETIC_CODE_COLUMNS:
+        if column not in df:
+            df[column] = None
+    missing = df[PHONETIC_CODE_COLUMNS[0]].isna() & df.street.notna()
+    if missing.any():
+        logger.info(f"Computing metaphone codes for {missing.sum()} addresses without stored codes")
+        codes = {street: phonetic_keys(street) for street in df.loc[missing, "street"].unique()}
+        for i, column in enumerate(PHONETIC_CODE_COLUMNS):
+            df.loc[missing, column] = df.loc[missing, "street"].map(lambda s: codes[s][i])
+    return df
+
+def store_phonetic_keys(engine, df):
+    """Fill in the missing metaphone codes and write them back to addresses, so that the next load reads them."""
+    missing = df[PHONETIC_CODE_COLUMNS[0]].isna() & df.street.notna()
+    if not missing.any():
+        return df
+    df = fill_phonetic_keys(df)
+    rows = df.loc[missing, ["id", *PHONETIC_CODE_COLUMNS]].astype(object)
+    rows = rows.where(rows.notna(), None).rename(columns={"id": "address_id"})
+    statement = (
+        update(addresses)
+        .where(addresses.c.id == bindparam("address_id"))
+        .values({column: bindparam(column) for column in PHONETIC_CODE_COLUMNS})
+    )
+    with engine.begin() as conn:
+        conn.execute(statement, rows.to_dict("records"))
+    logger.info(f"Stored metaphone codes for {len(rows)} addresses")
+    return df
+
+class ReferenceIndex:
+    """Compact in-memory copy of the addresses matching columns with hash-keyed candidate blocks.
+
+    Loaded once per run and shared by every match batch, so that candidate
+    lookup is a dict access instead of a boolean mask over all addresses.
+    Blocks hold integer row positions into df and the ids, units and
+    street_keys arrays. With spatial_radius_m and coordinates, grid finds
+    the addresses near a point. house_typos lets the stages that do not
+    block on the house number accept a typo of it (see match.house_guard).
+    """
+
+    def __init__(
+        self,
+        addr_df,
+        spatial_radius_m=config.pipeline.spatial_radius_m,
+        token_max_postings=config.pipeline.token_max_postings,
+        house_typos=True,
+    ):
+        df = compact_reference(fill_phonetic_keys(addr_df.reset_index(drop=True)))
+        self.phonetic_blocks = build_phonetic_blocks(df)
+        self.token_max_postings = token_max_postings
+        self.grid = None
+        if spatial_radius_m and all(column in df for column in COORDINATE_COLUMNS):
+            self.grid = GridIndex(*rounded_coordinates(df), spatial_radius_m)
+        # the metaphone codes and coordinates are only needed for the blocks and the grid
+        self.df = df.drop(columns=[*PHONETIC_CODE_COLUMNS, *COORDINATE_COLUMNS], errors="ignore")
+        self.ids = self.df.id.to_numpy()
+        self.units = self.df.aptnbr.to_numpy(dtype=object)
+        self.houses = self.df.house.to_numpy(dtype=object)
+        self.zips = self.df.zip.to_numpy(dtype=object)
+        self.house_typos = house_typos
+        self.street_keys = interned(street_keys(self.df.street.astype(object), self.df.strtype.astype(object)))
+        self.fuzzy_blocks = build_blocks(self.df, FUZZY_BLOCK_KEY)
+        logger.info(
+            f"Built reference index over {len(self.df)} addresses "
+            f"({len(self.fuzzy_blocks)} zip/house/city blocks, {len(self.phonetic_blocks)} phonetic blocks, "
+            f"{self.df.memory_usage(deep=True).sum() / 2**20:.1f} MB of columns)"
+        )
+
+    @cached_property
+    def house_street_keys(self):
+        """ "house street strtype" strings scored against spatial candidates. Built on first use."""
+        house = self.df.house.astype(object).fillna("").astype(str)
+        return interned((house + " " + pd.Series(self.street_keys)).str.strip())
+
+    @cached_property
+    def token_index(self):
+        """TokenIndex over TOKEN_FIELDS. Built on first use."""
+        fields = token_fields(self.df.house.to_numpy(dtype=object), self.street_keys, self.units, self.df.zip.to_numpy(dtype=object))
+        index = TokenIndex(fields, self.token_max_postings)
+        logger.info(f"Built token index over {len(self.df)} addresses ({len(index.vocabulary)} terms)")
+        return index
+
+    @cached_property
+    def token_keys(self):
+        """ "house street strtype zip" strings scored against token index candidates. Built on first use."""
+        zip_code = self.df.zip.astype(object).fillna("").astype(str)
+        return interned((pd.Series(self.house_street_keys) + " " + zip_code).str.strip())
+
+    @classmethod
+    def load(cls, engine, shard=None, shards=1):
+        """The addresses table, or only the addresses of one house number shard.
+
+        A shard accepts no house number typos: the intended house may hash to
+        another shard, so the result would depend on the shard count.
+        """
+        statement = select(*[addresses.c[column] for column in REFERENCE_COLUMNS])
+        if shard is not None:
+            statement = statement.where(shard_condition(addresses.c.house, shard, shards))
+        return cls(store_phonetic_keys(engine, pd.read_sql(statement, engine)), house_typos=shard is None)
+
+    def __len__(self):
+        return len(self.df)
+
+    @cached_property
+    def exact_blocks(self):
+        """Positions keyed by the full exact-match tuple, with nulls as None. Built on first use."""
+        values = self.df[EXACT_ADDR_FIELDS].astype(object)
+        values = values.where(values.notna(), None)
+        blocks = defaultdict(list)
+        for position, key in enumerate(values.itertuples(index=False, name=None)):
+            blocks[key].append(position)
+        return dict(blocks)
+
+    def exact_positions(self, record):
+        """Positions of the addresses equal to a parsed record on every exact-match field."""
+        key = tuple(None if pd.isna(record.get(field)) else record.get(field) for field in EXACT_TXN_FIELDS)
+        return self.exact_blocks.get(key, [])
+
+    def phonetic_positions(self, house, codes):
+        """Row positions sharing the house number and any of the given metaphone codes, in reference order."""
+        found = [self.phonetic_blocks[(house, code)] for code in codes if (house, code) in self.phonetic_blocks]
+        if not found:
+            return []
+        return found[0] if len(found) == 1 else np.unique(np.concatenate(found))
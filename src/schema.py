@@ -1,6 +1,7 @@
 from sqlalchemy import (
     Table,
     Column,
+    BigInteger,
     Integer,
     String,
     Float,
@@ -44,6 +45,7 @@ transactions_raw = Table(
     Column("presented_by_middle_name", String),
     Column("presented_by_suffix", String),
     Column("geog", String),
+    Column("content_hash", String),
 )
 
 transactions_parsed = Table(
@@ -83,6 +85,9 @@ addresses = Table(
     Column("latitude", Float),
     Column("longitude", Float),
     Column("homeownercd", String),
+    Column("street_metaphone", String),
+    Column("street_metaphone_alt", String),
+    Column("content_hash", String),
 )
 
 match_results = Table(
@@ -93,12 +98,85 @@ match_results = Table(
     Column("match_type", String),
     Column("confidence_score", Float),
     Column("matched_at", String),
+    Column("run_id", String),
 )
 
 unmatched_report = Table(
     "unmatched_report", metadata,
-    Column("transaction_id", Integer, ForeignKey("transactions_raw.id")),
+    Column("transaction_id", String, ForeignKey("transactions_raw.id")),
     Column("reason", String),
     Column("attempted_at", String),
+    Column("run_id", String),
 )
 
+
+ingest_changes = Table(
+    "ingest_changes", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("table_name", String),
+    Column("record_id", String),
+    Column("change_type", String),
+    Column("changed_at", String),
+)
+
+pipeline_state = Table(
+    "pipeline_state", metadata,
+    Column("key", String, primary_key=True),
+    Column("value", String),
+)
+
+run_ledger = Table(
+    "run_ledger", metadata,
+    Column("run_id", String, primary_key=True),
+    Column("stage", String, primary_key=True),
+    Column("status", String),
+    Column("last_key", String),
+    Column("rows_in", BigInteger),
+    Column("rows_out", BigInteger),
+    Column("started_at", String),
+    Column("updated_at", String),
+)
+
+# Idempotent statements bringing a database created from an older init.sql up to
+# this schema. init.sql only runs on an empty data volume, so db.migrate runs these
+# at startup instead.
+MIGRATIONS = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "ALTER TABLE addresses ADD COLUMN IF NOT EXISTS street_metaphone TEXT",
+    "ALTER TABLE addresses ADD COLUMN IF NOT EXISTS street_metaphone_alt TEXT",
+    "ALTER TABLE addresses ADD COLUMN IF NOT EXISTS content_hash TEXT",
+    "ALTER TABLE transactions_raw ADD COLUMN IF NOT EXISTS content_hash TEXT",
+    "ALTER TABLE match_results ADD COLUMN IF NOT EXISTS run_id TEXT",
+    "ALTER TABLE unmatched_report ADD COLUMN IF NOT EXISTS run_id TEXT",
+    """CREATE TABLE IF NOT EXISTS ingest_changes (
+        id SERIAL PRIMARY KEY,
+        table_name TEXT,
+        record_id TEXT,
+        change_type TEXT,
+        changed_at TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS pipeline_state (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS run_ledger (
+        run_id TEXT,
+        stage TEXT,
+        status TEXT,
+        last_key TEXT,
+        rows_in BIGINT,
+        rows_out BIGINT,
+        started_at TEXT,
+        updated_at TEXT,
+        PRIMARY KEY (run_id, stage)
+    )""",
+    """CREATE INDEX IF NOT EXISTS idx_addresses_street_trgm ON addresses
+        USING gin ((btrim(coalesce(street, '') || ' ' || coalesce(strtype, ''))) gin_trgm_ops)""",
+    "CREATE INDEX IF NOT EXISTS idx_addresses_phonetic ON addresses (house, street_metaphone)",
+    "CREATE INDEX IF NOT EXISTS idx_addresses_phonetic_alt ON addresses (house, street_metaphone_alt)",
+    "CREATE INDEX IF NOT EXISTS idx_match_address_id ON match_results(address_id)",
+    "CREATE INDEX IF NOT EXISTS idx_match_run_id ON match_results(run_id)",
+    "CREATE INDEX IF NOT EXISTS idx_unmatched_run_id ON unmatched_report(run_id)",
+    "CREATE INDEX IF NOT EXISTS idx_unmatched_transaction_id ON unmatched_report(transaction_id)",
+    "CREATE INDEX IF NOT EXISTS idx_ingest_changes_table ON ingest_changes(table_name, id)",
+]
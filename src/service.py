@@ -0,0 +1,139 @@
+from config import config
+from db import get_connection, migrate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from match import match_record
+from parse import parse_address, PARSE_ERRORS
+from parse_cache import ParseCache
+from reference import ReferenceIndex
+import json
+import logging
+import threading
+import time
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+logger = logging.getLogger(__name__)
+
+engine = get_connection()
+
+class MatchService:
+    """Resolves raw addresses against an in-memory reference that can be swapped without a restart."""
+
+    def __init__(self, ref=None):
+        self.ref = ref if ref is not None else ReferenceIndex.load(engine)
+        # build eagerly so the first request does not pay for it
+        self.ref.exact_blocks
+        if config.pipeline.token_top_k:
+            self.ref.token_index
+        self.cache = ParseCache(path=None)
+        self.cache_lock = threading.Lock()
+        self.reload_lock = threading.Lock()
+
+    def reload(self):
+        """Load a fresh reference and swap it in. In-flight requests finish on the old one."""
+        with self.reload_lock:
+            ref = ReferenceIndex.load(engine)
+            ref.exact_blocks
+            if config.pipeline.token_top_k:
+                ref.token_index
+            self.ref = ref
+        return len(ref)
+
+    def parse(self, address):
+        with self.cache_lock:
+            cached = self.cache.get_many([address]).get(address)
+        if cached is not None:
+            return cached
+        try:
+            entry = ("ok", parse_address(address))
+        except PARSE_ERRORS as e:
+            entry = ("error", str(e))
+        with self.cache_lock:
+            self.cache.put_many({address: entry})
+        return entry
+
+    def match(self, address):
+        ref = self.ref
+        status, value = self.parse(address)
+        if status == "error":
+            return {"address": address, "parsed": None, "matches": [], "reason": value}
+        matches = [
+            {"address_id": int(address_id), "match_type": match_type, "confidence_score": float(score)}
+            for address_id, match_type, score in match_record(value, ref)
+        ]
+        return {
+            "address": address,
+            "parsed": value,
+            "matches": matches,
+            "reason": None if matches else "no match",
+        }
+
+class MatchRequestHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.send_json(200, {"status": "ok", "addresses": len(self.service.ref)})
+        else:
+            self.send_json(404, {"error": f"unknown path {self.path}"})
+
+    def do_POST(self):
+        try:
+            body = self.read_json()
+        except json.JSONDecodeError as e:
+            self.send_json(400, {"error": f"invalid JSON: {e}"})
+            return
+        if not isinstance(body, dict):
+            self.send_json(400, {"error": "expected a JSON object"})
+            return
+
+        start = time.perf_counter()
+        if self.path == "/match":
+            address = body.get("address")
+            if not isinstance(address, str):
+                self.send_json(400, {"error": "expected {\"address\": \"...\"}"})
+                return
+            result = self.service.match(address)
+        elif self.path == "/match/batch":
+            addresses = body.get("addresses")
+            if not isinstance(addresses, list) or not all(isinstance(a, str) for a in addresses):
+                self.send_json(400, {"error": "expected {\"addresses\": [\"...\", ...]}"})
+                return
+            if len(addresses) > config.service.max_batch:
+                self.send_json(413, {"error": f"at most {config.service.max_batch} addresses per request"})
+                return
+            result = {"results": [self.service.match(address) for address in addresses]}
+        elif self.path == "/reload":
+            result = {"addresses": self.service.reload()}
+        else:
+            self.send_json(404, {"error": f"unknown path {self.path}"})
+            return
+        result["elapsed_ms"] = (time.perf_counter() - start) * 1000
+        self.send_json(200, result)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+def serve(host=config.service.host, port=config.service.port):
+    migrate()
+    MatchRequestHandler.service = MatchService()
+    server = ThreadingHTTPServer((host, port), MatchRequestHandler)
+    logger.info(f"Matching service listening on {host}:{port}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    serve()
@@ -0,0 +1,195 @@
+from normalize import STREET_TYPE_ABBR, USPS_SECONDARY_UNITS
+import argparse
+import logging
+import numpy as np
+import os
+import pandas as pd
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+logger = logging.getLogger(__name__)
+
+SYLLABLES = np.array([
+    "WITH", "ERS", "BED", "FORD", "KENT", "GRAND", "METRO", "POL", "ITAN", "HAV", "EMEYER", "ROE",
+    "BLING", "DRIGGS", "LOR", "IMER", "UNION", "HEW", "ES", "LEE", "DIV", "ISION", "WYTHE", "BER",
+    "RY", "NAS", "SAU", "ECK", "FORD", "MAN", "HAT", "TAN", "HOOP", "ER", "GRA", "HAM", "SKILL", "MAN",
+])
+CITIES = [("BROOKLYN", "NY", "11211"), ("BROOKLYN", "NY", "11206"), ("BROOKLYN", "NY", "11249"), ("BROOKLYN", "NY", "11222")]
+STREET_TYPES = np.array(list(STREET_TYPE_ABBR))
+UNIT_TYPES = np.array(["APARTMENT", "UNIT", "SUITE", "FLOOR"])
+UNIT_ABBR = np.array([USPS_SECONDARY_UNITS[unit] for unit in UNIT_TYPES])
+
+def street_vocabulary(rng, size):
+    """Distinct made-up street names built from a few syllables."""
+    names = set()
+    while len(names) < size:
+        count = rng.integers(1, 4)
+        names.add("".join(rng.choice(SYLLABLES, count)))
+    return np.array(sorted(names))
+
+def generate_addresses(n, seed=0):
+    """Reference addresses shaped like the addresses CSV, with abbreviated street and unit types."""
+    rng = np.random.default_rng(seed)
+    streets = street_vocabulary(rng, max(10, int(np.sqrt(n))))
+    city_idx = rng.integers(0, len(CITIES), n)
+    has_unit = rng.random(n) < 0.4
+    type_idx = rng.integers(0, len(STREET_TYPES), n)
+    unit_idx = rng.integers(0, len(UNIT_TYPES), n)
+    df = pd.DataFrame({
+        "id": np.arange(1, n + 1),
+        "hhid": rng.integers(10**8, 10**9, n).astype(str),
+        "fname": "JANE",
+        "mname": None,
+        "lname": "DOE",
+        "suffix": None,
+        "house": rng.integers(1, 2000, n).astype(str),
+        "predir": None,
+        "street": rng.choice(streets, n),
+        "strtype": np.array([STREET_TYPE_ABBR[t] for t in STREET_TYPES])[type_idx],
+        "postdir": None,
+        "apttype": np.where(has_unit, UNIT_ABBR[unit_idx], None),
+        "aptnbr": np.where(has_unit, pd.Series(rng.integers(1, 30, n)).astype(str) + rng.choice(list("ABCD"), n), None),
+        "city": [CITIES[i][0] for i in city_idx],
+        "state": [CITIES[i][1] for i in city_idx],
+        "zip": [CITIES[i][2] for i in city_idx],
+        "latitude": 40.70 + rng.random(n) * 0.03,
+        "longitude": -73.97 + rng.random(n) * 0.03,
+        "homeownercd": rng.choice(["O", "R"], n),
+    })
+    df.insert(6, "address", df.house + " " + df.street + " " + df.strtype)
+    # remember the long street type so transactions can spell it out
+    df.attrs["street_type_long"] = STREET_TYPES[type_idx]
+    df.attrs["unit_type_long"] = np.where(has_unit, UNIT_TYPES[unit_idx], None)
+    return df
+
+def add_typo(rng, names):
+    """Drop, double or swap one character of each name."""
+    out = []
+    for name in names:
+        if len(name) < 3:
+            out.append(name)
+            continue
+        i = rng.integers(1, len(name) - 1)
+        kind = rng.integers(0, 3)
+        if kind == 0:
+            out.append(name[:i] + name[i + 1:])
+        elif kind == 1:
+            out.append(name[:i] + name[i] + name[i:])
+        else:
+            out.append(name[:i - 1] + name[i] + name[i - 1] + name[i + 1:])
+    return np.array(out, dtype=object)
+
+def add_house_typo(rng, houses):
+    """Swap two adjacent digits of each house number, or drop or double one digit.
+
+    Never a changed digit: that is the neighbouring house, not a typo of this one.
+    """
+    out = []
+    for house in houses:
+        kind = rng.integers(0, 3) if len(house) > 1 else 1
+        i = rng.integers(0, len(house) - 1) if kind == 2 else rng.integers(0, len(house))
+        if kind == 0:
+            out.append(house[:i] + house[i + 1:])
+        elif kind == 1:
+            out.append(house[:i] + house[i] + house[i:])
+        else:
+            out.append(house[:i] + house[i + 1] + house[i] + house[i + 2:])
+    return np.array(out, dtype=object)
+
+def generate_transactions(addr_df, n, duplicate_rate=0.3, typo_rate=0.05, unit_noise_rate=0.05,
+                          unparseable_rate=0.02, house_typo_rate=0.0, seed=1, start=0):
+    """Transactions referring to addresses in addr_df, shaped like the transactions CSV.
+
+    duplicate_rate is the share of rows relisting an address already used in
+    this chunk. typo_rate is the share with a misspelled street. unit_noise_rate
+    is the share with a wrong or missing unit. unparseable_rate is the share
+    without a house number. house_typo_rate is the share with swapped,
+    dropped or doubled digits in the house number. The token and spatial
+    stages recover the swapped and doubled ones; a dropped digit may leave
+    another house's number, so it stays unmatched.
+    """
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(0, len(addr_df), n)
+    duplicates = rng.random(n) < duplicate_rate
+    if n > 1:
+        earlier = (rng.random(n) * np.arange(n)).astype(int)
+        picks = np.where(duplicates, picks[earlier], picks)
+    addr = addr_df.iloc[picks].reset_index(drop=True)
+    type_long = addr_df.attrs["street_type_long"][picks]
+    unit_long = addr_df.attrs["unit_type_long"][picks]
+
+    street = addr.street.to_numpy(dtype=object).copy()
+    typos = rng.random(n) < typo_rate
+    street[typos] = add_typo(rng, street[typos])
+
+    unit_id = addr.aptnbr.to_numpy(dtype=object).copy()
+    noisy = (rng.random(n) < unit_noise_rate) & pd.notna(unit_id)
+    unit_id[noisy] = np.where(rng.random(noisy.sum()) < 0.5, None, "9Z")
+
+    house = addr.house.astype(str).to_numpy(dtype=object).copy()
+    if house_typo_rate:
+        # drawn only when asked for, so that the other rates still give the same rows for a seed
+        house_typos = rng.random(n) < house_typo_rate
+        house[house_typos] = add_house_typo(rng, house[house_typos])
+    house = pd.Series(house)
+    street_words = pd.Series(street).astype(str).str.title()
+    type_words = pd.Series(type_long).astype(str).str.title()
+    unparseable = rng.random(n) < unparseable_rate
+    # no house number: usaddress does not tag these as a street address
+    line_1 = (house + " " + street_words + " " + type_words).where(~unparseable, street_words + " " + type_words)
+    has_unit = pd.notna(unit_id) & pd.notna(unit_long)
+    unit_words = pd.Series(unit_long).fillna("").astype(str).str.title() + " " + pd.Series(unit_id).fillna("").astype(str)
+    line_2 = unit_words.where(has_unit, None)
+
+    df = pd.DataFrame({
+        "id": [f"txn-{i:09d}" for i in range(start, start + n)],
+        "status": rng.choice(["for_sale", "sold", "pending"], n),
+        "price": rng.integers(200000, 3000000, n),
+        "bedrooms": rng.integers(0, 5, n),
+        "bathrooms": rng.integers(1, 4, n),
+        "square_feet": rng.integers(400, 3000, n),
+        "address_line_1": line_1.to_numpy(),
+        "address_line_2": line_2.to_numpy(),
+        "city": addr.city.str.title(),
+        "state": addr.state,
+        "zip_code": addr.zip,
+        "property_type": "condo",
+        "latitude": addr.latitude + rng.normal(0, 0.00005, n),
+        "longitude": addr.longitude + rng.normal(0, 0.00005, n),
+    })
+    # ground truth for measuring the matchers; not written out
+    df.attrs["address_ids"] = addr.id.to_numpy()
+    df.attrs["house_typos"] = house_typos if house_typo_rate else np.zeros(n, dtype=bool)
+    return df
+
+def write_dataset(out_dir, n_addresses, n_transactions, chunk_size=1_000_000, seed=0, **noise):
+    """Write addresses.csv and transactions.csv under out_dir, generating transactions chunk by chunk."""
+    os.makedirs(out_dir, exist_ok=True)
+    addresses_path = os.path.join(out_dir, "addresses.csv")
+    transactions_path = os.path.join(out_dir, "transactions.csv")
+    addr_df = generate_addresses(n_addresses, seed)
+    addr_df.to_csv(addresses_path, index=False)
+    for start in range(0, n_transactions, chunk_size):
+        size = min(chunk_size, n_transactions - start)
+        txn_df = generate_transactions(addr_df, size, seed=seed + 1 + start, start=start, **noise)
+        txn_df.to_csv(transactions_path, mode="w" if start == 0 else "a", header=start == 0, index=False)
+    logger.info(f"Wrote {n_addresses} addresses and {n_transactions} transactions to {out_dir}")
+    return addresses_path, transactions_path
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic addresses and transactions CSVs.")
+    parser.add_argument("out_dir")
+    parser.add_argument("--addresses", type=int, default=10_000)
+    parser.add_argument("--transactions", type=int, default=10_000)
+    parser.add_argument("--duplicate-rate", type=float, default=0.3)
+    parser.add_argument("--typo-rate", type=float, default=0.05)
+    parser.add_argument("--unit-noise-rate", type=float, default=0.05)
+    parser.add_argument("--unparseable-rate", type=float, default=0.02)
+    parser.add_argument("--house-typo-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    write_dataset(
+        args.out_dir, args.addresses, args.transactions, seed=args.seed,
+        duplicate_rate=args.duplicate_rate, typo_rate=args.typo_rate,
+        unit_noise_rate=args.unit_noise_rate, unparseable_rate=args.unparseable_rate,
+        house_typo_rate=args.house_typo_rate,
+    )
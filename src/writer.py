@@ -0,0 +1,116 @@
+from collections import defaultdict
+from config import config
+from db import get_connection, copy_dataframe
+from ledger import checkpoint
+from metrics import metrics
+from schema import metadata
+import logging
+import pandas as pd
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+logger = logging.getLogger(__name__)
+
+# parents before children, so a flush never violates a foreign key
+TABLE_ORDER = [table.name for table in metadata.sorted_tables]
+
+class BufferedWriter:
+    """Buffers result rows for several tables and writes them with COPY.
+
+    A flush happens once max_rows rows or max_bytes bytes are buffered, and
+    when the writer is closed. Each flush writes every buffered table in one
+    transaction. Rows of tables with a run_id column are stamped with run_id.
+    Flush time is recorded as the "write" phase of stage.
+
+    With ledger_stage, the caller calls checkpoint after adding the rows of
+    each input batch, and flushes only happen there. Each flush then also
+    moves the stage's run_ledger row to the last checkpointed key in the
+    same transaction, so committed results and the resume position never
+    disagree and a resumed stage neither loses nor repeats a batch.
+    """
+
+    def __init__(
+        self,
+        engine=None,
+        max_rows=config.writer.max_rows,
+        max_bytes=config.writer.max_bytes,
+        run_id=None,
+        stage="results",
+        ledger_stage=None,
+    ):
+        self.engine = engine if engine is not None else get_connection()
+        self.run_id = run_id
+        self.stage = stage
+        self.ledger_stage = ledger_stage
+        self.position = None
+        self.pending_rows_in = 0
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.buffers = defaultdict(list)
+        self.rows = 0
+        self.bytes = 0
+
+    def add(self, table_name, rows):
+        """Buffer a DataFrame or a list of dicts for table_name."""
+        df = rows if isinstance(rows, pd.DataFrame) else pd.DataFrame(rows)
+        if df.empty:
+            return
+        if self.run_id is not None and "run_id" in metadata.tables[table_name].c:
+            df = df.assign(run_id=self.run_id)
+        self.buffers[table_name].append(df)
+        self.rows += len(df)
+        self.bytes += int(df.memory_usage(deep=True).sum())
+        if self.ledger_stage is None:
+            self.flush_if_full()
+
+    def checkpoint(self, position, rows_in):
+        """Mark everything added so far as the results of the input up to position, which took rows_in rows."""
+        self.position = position
+        self.pending_rows_in += rows_in
+        self.flush_if_full()
+
+    def flush_if_full(self):
+        if self.rows >= self.max_rows or self.bytes >= self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        if not self.rows and self.position is None:
+            return
+        written = {}
+        with metrics.timer("phase_seconds", stage=self.stage, phase="write"):
+            conn = self.engine.raw_connection()
+            try:
+                with conn.cursor() as cursor:
+                    for table_name in sorted(self.buffers, key=TABLE_ORDER.index):
+                        df = pd.concat(self.buffers[table_name], ignore_index=True)
+                        copy_dataframe(cursor, table_name, df)
+                        written[table_name] = len(df)
+                    if self.ledger_stage is not None and self.position is not None:
+                        checkpoint(
+                            cursor, self.run_id, self.ledger_stage, self.position,
+                            self.pending_rows_in, sum(written.values()),
+                        )
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                conn.close()
+        self.buffers.clear()
+        self.rows = 0
+        self.bytes = 0
+        self.position = None
+        self.pending_rows_in = 0
+        for table_name, count in written.items():
+            metrics.inc("rows_written_total", count, table=table_name)
+            logger.info(f"Flushed {count} rows into {table_name}")
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # keep what was buffered before a failure only if the stage finished cleanly
+        if exc_type is None:
+            self.close()
@@ -0,0 +1,69 @@
+import os
+import sys
+
+# the pipeline modules are flat scripts run from src/, and create their engine on import without connecting
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+import pandas as pd
+import pytest
+
+
+@pytest.fixture(scope="session")
+def synthetic_dataset(tmp_path_factory):
+    """(addresses, raw transactions) of a small synthetic dataset, read back like the file pipeline reads its inputs."""
+    from file_pipeline import read_table_chunks
+    from ingest import prepare_addresses
+    from schema import addresses, transactions_raw
+    from synthetic import write_dataset
+
+    addresses_path, transactions_path = write_dataset(
+        str(tmp_path_factory.mktemp("synthetic")), 2000, 4000, typo_rate=0.1, house_typo_rate=0.05
+    )
+    addr_df = pd.concat(read_table_chunks(addresses_path, addresses, prepare_addresses), ignore_index=True)
+    raw_df = pd.concat(read_table_chunks(transactions_path, transactions_raw), ignore_index=True)
+    return addr_df, raw_df
+
+
+@pytest.fixture(scope="session")
+def reference(synthetic_dataset):
+    from reference import ReferenceIndex
+
+    return ReferenceIndex(synthetic_dataset[0])
+
+
+@pytest.fixture(scope="session")
+def parsed_transactions(synthetic_dataset):
+    """Parsed synthetic transactions with the listing coordinates, as the matchers receive them."""
+    from parse import parse_batch
+    from reference import COORDINATE_COLUMNS
+    from schema import transactions_parsed
+
+    raw_df = synthetic_dataset[1]
+    parsed_rows, _ = parse_batch(raw_df)
+    parsed_df = pd.DataFrame(parsed_rows, columns=[column.name for column in transactions_parsed.columns])
+    return parsed_df.merge(raw_df[["id", *COORDINATE_COLUMNS]], on="id", how="left")
+
+
+@pytest.fixture(scope="session")
+def house_typo_dataset(tmp_path_factory):
+    """(reference, parsed transactions, true address ids, house typo flags) with a third of the house numbers mistyped."""
+    from file_pipeline import read_table_chunks
+    from ingest import prepare_addresses
+    from parse import parse_batch
+    from reference import ReferenceIndex, COORDINATE_COLUMNS
+    from schema import addresses, transactions_parsed
+    from synthetic import generate_addresses, generate_transactions
+
+    addresses_path = str(tmp_path_factory.mktemp("house_typos") / "addresses.csv")
+    generated = generate_addresses(3000)
+    generated.to_csv(addresses_path, index=False)
+    addr_df = pd.concat(read_table_chunks(addresses_path, addresses, prepare_addresses), ignore_index=True)
+    raw_df = generate_transactions(
+        generated, 3000, duplicate_rate=0, typo_rate=0.05, unit_noise_rate=0, unparseable_rate=0, house_typo_rate=0.3
+    )
+    parsed_rows, _ = parse_batch(raw_df)
+    parsed_df = pd.DataFrame(parsed_rows, columns=[column.name for column in transactions_parsed.columns])
+    parsed_df = parsed_df.merge(raw_df[["id", *COORDINATE_COLUMNS]], on="id", how="left")
+    truth = pd.Series(raw_df.attrs["address_ids"], index=raw_df.id)
+    typos = pd.Series(raw_df.attrs["house_typos"], index=raw_df.id)
+    return ReferenceIndex(addr_df), parsed_df, truth, typos
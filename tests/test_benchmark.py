@@ -0,0 +1,22 @@
+from benchmark import run_benchmark
+from metrics import metrics
+
+
+def test_benchmark_runs_the_batched_file_pipeline(tmp_path):
+    result = run_benchmark(str(tmp_path), 500, 2000, workers=1, chunk_size=500)
+    stages = {stage["stage"]: stage for stage in result["stages"]}
+    assert stages["parse"]["batches"] == 4
+    assert stages["parse"]["rows"] == 2000
+    assert stages["match"]["batches"] == 4
+    assert "exact_match" in stages and "files_write" in stages
+    assert (tmp_path / "matches.csv").exists()
+    assert result["summary"]["matched_transactions"] > 0.9 * 2000
+
+
+def test_benchmark_does_not_reuse_the_parse_cache_across_runs(tmp_path):
+    hits = []
+    for run in ("first", "second"):
+        run_benchmark(str(tmp_path / run), 200, 600, workers=1, chunk_size=300)
+        hits.append((metrics.counters[("parse_cache_hits_total", ())], metrics.counters[("parse_cache_misses_total", ())]))
+    assert hits[0] == hits[1]
+    assert hits[0][1] > 0
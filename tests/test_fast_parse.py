@@ -0,0 +1,57 @@
+from config import config
+from fast_parse import compare_with_usaddress, fast_tag
+from parse import assemble_address
+from parse_cache import ParseCache
+import importlib
+import parse_cache
+import pytest
+
+
+def test_fast_tag_agrees_with_usaddress(synthetic_dataset):
+    addresses = [assemble_address(row) for row in synthetic_dataset[1].head(2000).to_dict("records")]
+    result = compare_with_usaddress(addresses)
+    assert result["mismatches"] == []
+    assert result["hit_rate"] > 0.8
+
+
+def test_fast_tag_labels():
+    assert fast_tag("237 North Withers Street East, Unit 2A, Brooklyn NY 11211") == {
+        "AddressNumber": "237",
+        "StreetNamePreDirectional": "North",
+        "StreetName": "Withers",
+        "StreetNamePostType": "Street",
+        "StreetNamePostDirectional": "East",
+        "OccupancyType": "Unit",
+        "OccupancyIdentifier": "2A",
+        "PlaceName": "Brooklyn",
+        "StateName": "NY",
+        "ZipCode": "11211",
+    }
+
+
+@pytest.mark.parametrize("address", [
+    "237 Withers St, Brooklyn NY 11211",  # abbreviated type
+    "237 Withers Street, Brooklyn NY 11211-1234",  # zip+4
+    "Withers Street, Brooklyn NY 11211",  # no house number
+    "12 North Street, Brooklyn NY 11211",  # name made only of a directional
+    "PO Box 12, Brooklyn NY 11211",
+])
+def test_irregular_shapes_go_to_usaddress(address):
+    assert fast_tag(address) is None
+
+
+def test_cache_key_depends_on_fast_path(monkeypatch, tmp_path):
+    versions = {}
+    for fast in (True, False):
+        monkeypatch.setattr(config.pipeline, "fast_parse", fast)
+        versions[fast] = importlib.reload(parse_cache).PARSER_VERSION
+    monkeypatch.undo()
+    importlib.reload(parse_cache)
+    assert versions[True] != versions[False]
+
+    path = str(tmp_path / "parse_cache.sqlite")
+    fast_cache = ParseCache(path=path, version=versions[True])
+    fast_cache.put_many({"1 A Street, Brooklyn NY 11211": ("ok", {"street_number": "1"})})
+    fast_cache.close()
+    assert ParseCache(path=path, version=versions[False]).get_many(["1 A Street, Brooklyn NY 11211"]) == {}
+    assert ParseCache(path=path, version=versions[True]).get_many(["1 A Street, Brooklyn NY 11211"]) != {}
@@ -0,0 +1,19 @@
+from schema import run_ledger
+from sqlalchemy import create_engine, insert
+import ledger
+
+
+def test_latest_unfinished_run_skips_standalone_stage_runs(monkeypatch):
+    engine = create_engine("sqlite://")
+    run_ledger.create(engine)
+    with engine.begin() as conn:
+        conn.execute(insert(run_ledger), [
+            {"run_id": "20260101T000000", "stage": "pipeline", "status": ledger.RUNNING},
+            {"run_id": "20260101T000000", "stage": "ingest.addresses", "status": ledger.DONE},
+            {"run_id": "20260102T000000", "stage": "pipeline", "status": ledger.DONE},
+            # a crashed standalone match.py run, which has no pipeline row
+            {"run_id": "20260103T000000", "stage": "match", "status": ledger.RUNNING},
+        ])
+    monkeypatch.setattr(ledger, "engine", engine)
+    assert ledger.latest_unfinished_run("pipeline") == "20260101T000000"
+    assert ledger.latest_unfinished_run("match") == "20260103T000000"
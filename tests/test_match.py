@@ -0,0 +1,181 @@
+from match import is_house_typo, match_keys, match_record, match_transactions, run_waterfall, spatial_match, token_match, KeyMemo
+from metrics import metrics
+from reference import ReferenceIndex
+import numpy as np
+import pandas as pd
+import pytest
+
+
+def result_set(matches):
+    return set(matches[["transaction_id", "address_id", "match_type", "confidence_score"]].itertuples(index=False, name=None))
+
+
+def test_memo_evicts_least_recently_used():
+    memo = KeyMemo(max_entries=2)
+    memo.put("a", [])
+    memo.put("b", [(1, "exact", 1.0)])
+    memo.get("a")
+    memo.put("c", [])
+    assert "a" in memo and "c" in memo and "b" not in memo
+
+
+def test_match_keys_ignore_coordinates(parsed_transactions):
+    rows = parsed_transactions.head(1)
+    moved = rows.assign(id="moved", latitude=rows.latitude + 0.01, longitude=rows.longitude - 0.01)
+    assert match_keys(pd.concat([rows, moved])) == match_keys(rows) * 2
+
+
+def test_fan_out_matches_the_plain_waterfall(reference, parsed_transactions):
+    expected_matches, expected_report = run_waterfall(parsed_transactions, reference)
+    matches, report = match_transactions(parsed_transactions, reference, memo=KeyMemo())
+    assert result_set(matches) == result_set(expected_matches)
+    assert set(report.transaction_id) == set(expected_report.transaction_id)
+
+
+def test_spatial_runs_per_listing_outside_the_memo(reference, synthetic_dataset, monkeypatch):
+    monkeypatch.setattr("match.TOKEN_TOP_K", 0)
+    addr_df = synthetic_dataset[0]
+    address = addr_df[addr_df.aptnbr.isna() & (addr_df.street.str.len() > 5)].iloc[0]
+    # a misspelling that changes the metaphone code, in a zip that blocks nothing
+    street = address.street[:3] + "X" + address.street[4:]
+    listing = {
+        "street_number": address.house, "street_name": street, "street_type": address.strtype,
+        "unit_type": None, "unit_identifier": None, "city": address.city, "state": address.state, "zip": "00000",
+    }
+    txn_df = pd.DataFrame([
+        {"id": "here", **listing, "latitude": address.latitude, "longitude": address.longitude},
+        {"id": "far", **listing, "latitude": address.latitude + 1, "longitude": address.longitude},
+    ])
+    memo = KeyMemo()
+    for _ in range(2):
+        matches, report = match_transactions(txn_df, reference, memo=memo)
+        assert result_set(matches) == {("here", address.id, "spatial", matches.confidence_score.iloc[0])}
+        assert list(report.transaction_id) == ["far"]
+
+
+def test_memo_is_reused_across_batches(reference, parsed_transactions):
+    expected, _ = match_transactions(parsed_transactions, reference)
+    memo = KeyMemo()
+    metrics.reset()
+    batches = [match_transactions(batch, reference, memo=memo)[0] for _, batch in parsed_transactions.groupby(np.arange(len(parsed_transactions)) // 1000)]
+    assert result_set(pd.concat(batches)) == result_set(expected)
+    # the synthetic listings repeat addresses across batches
+    assert metrics.counters[("match_keys_total", (("source", "memo"),))] > 0
+
+
+def test_match_record_agrees_with_the_batch_waterfall(reference, parsed_transactions):
+    sample = parsed_transactions.sample(500, random_state=0)
+    matches, _ = match_transactions(sample, reference)
+    by_transaction = matches.groupby("transaction_id").apply(
+        lambda rows: sorted(zip(rows.address_id, rows.match_type)), include_groups=False
+    ).to_dict()
+    for record in sample.to_dict("records"):
+        got = sorted((address_id, match_type) for address_id, match_type, _ in match_record(record, reference))
+        assert got == by_transaction.get(record["id"], [])
+
+
+@pytest.mark.parametrize("house, candidate, expected", [
+    ("123", "132", True),  # adjacent swap
+    ("123", "213", True),
+    ("123", "1233", True),  # doubled digit
+    ("1233", "123", True),
+    ("44", "4", True),
+    ("123", "125", False),  # the neighbour
+    ("123", "1234", False),  # other houses on the same street
+    ("123", "9123", False),
+    ("123", "23", False),
+    ("123", "12", False),
+    ("123", "13", False),
+    ("45", "4", False),
+    ("123", "321", False),
+    ("123", "123", False),
+    ("123", "1", False),
+    ("12A", "21A", True),
+])
+def test_is_house_typo(house, candidate, expected):
+    assert is_house_typo(house, candidate) == expected
+
+
+def street_reference(house_typos=True):
+    """Houses 123 and 132 MAIN ST and 125 MAIN ST a few meters apart, plus 123 OAK AVE across the street."""
+    return ReferenceIndex(pd.DataFrame([
+        {"id": 1, "house": "125", "street": "MAIN", "strtype": "ST", "zip": "11211", "latitude": 40.71, "longitude": -73.95},
+        {"id": 2, "house": "132", "street": "MAIN", "strtype": "ST", "zip": "11211", "latitude": 40.71002, "longitude": -73.95},
+        {"id": 3, "house": "123", "street": "OAK", "strtype": "AVE", "zip": "11211", "latitude": 40.71004, "longitude": -73.95},
+        {"id": 4, "house": "77", "street": "MAIN", "strtype": "ST", "zip": "11222", "latitude": 40.71001, "longitude": -73.95},
+    ]).assign(apttype=None, aptnbr=None, city="BROOKLYN", state="NY"), house_typos=house_typos)
+
+
+def listing(transaction_id, house, street="MAIN", zip_code="11211", street_type="ST"):
+    return {
+        "id": transaction_id, "street_number": house, "street_name": street, "street_type": street_type,
+        "unit_type": None, "unit_identifier": None, "city": "BROOKLYN", "state": "NY", "zip": zip_code,
+        "latitude": 40.71001, "longitude": -73.95,
+    }
+
+
+def test_spatial_rejects_the_neighbouring_house():
+    assert spatial_match(pd.DataFrame([listing("neighbour", "124")]), street_reference()).empty
+
+
+def test_spatial_accepts_house_typos_on_the_same_street_and_zip():
+    matches = spatial_match(pd.DataFrame([
+        listing("swapped", "123"),  # 132 MAIN ST, since 123 MAIN ST does not exist
+        listing("wrong zip", "132", zip_code="11249"),
+        listing("typo in another zip", "123", zip_code="11249"),
+        listing("doubled", "777", zip_code="11222"),
+    ]), street_reference())
+    assert dict(zip(matches.transaction_id, matches.address_id)) == {"swapped": 2, "wrong zip": 2, "doubled": 4}
+
+
+def test_spatial_needs_the_same_house_on_a_shard():
+    ref = street_reference(house_typos=False)
+    matches = spatial_match(pd.DataFrame([listing("swapped", "123"), listing("wrong zip", "132", zip_code="11249")]), ref)
+    assert dict(zip(matches.transaction_id, matches.address_id)) == {"wrong zip": 2}
+
+
+def test_match_record_uses_the_guard_too():
+    assert match_record(listing("neighbour", "124"), street_reference()) == []
+
+
+def guarded_typos(ref, parsed_df, truth, typos):
+    """Whether each mistyped house number is one house_guard accepts: a swap or a doubled digit, not a dropped one."""
+    true_houses = pd.Series(ref.houses, index=ref.ids)[truth].to_numpy()
+    typed = parsed_df.set_index("id").street_number[truth.index].to_numpy()
+    return typos & np.array([isinstance(t, str) and is_house_typo(t, h) for t, h in zip(typed, true_houses)])
+
+
+def assert_recovers_house_typos(matches, ref, parsed_df, truth, typos):
+    guarded = guarded_typos(ref, parsed_df, truth, typos)
+    # a dropped digit leaves another valid house number, so only the guarded typos and the clean records count
+    matches = matches[matches.transaction_id.isin(truth.index[guarded | ~typos])]
+    correct = matches.address_id.to_numpy() == truth[matches.transaction_id].to_numpy()
+    assert correct.all()
+    assert len(matches[matches.transaction_id.isin(truth.index[guarded])]) > 0.8 * guarded.sum()
+
+
+def test_spatial_recovers_house_typos_without_false_matches(house_typo_dataset, monkeypatch):
+    monkeypatch.setattr("match.TOKEN_TOP_K", 0)
+    ref, parsed_df, truth, typos = house_typo_dataset
+    matches, _ = match_transactions(parsed_df, ref)
+    assert_recovers_house_typos(matches[matches.match_type == "spatial"], ref, parsed_df, truth, typos)
+
+
+def test_token_rejects_the_neighbouring_house():
+    assert token_match(pd.DataFrame([listing("neighbour", "123", zip_code="11249")]), street_reference()).empty
+
+
+def test_token_accepts_house_typos_on_the_same_street_and_zip():
+    matches = token_match(pd.DataFrame([listing("swapped", "123"), listing("wrong zip", "125", zip_code="11249")]), street_reference())
+    assert dict(zip(matches.transaction_id, matches.address_id)) == {"swapped": 2, "wrong zip": 1}
+
+
+def test_token_needs_the_same_house_on_a_shard():
+    matches = token_match(pd.DataFrame([listing("swapped", "123")]), street_reference(house_typos=False))
+    assert matches.empty
+
+
+def test_token_recovers_house_typos_without_false_matches(house_typo_dataset):
+    ref, parsed_df, truth, typos = house_typo_dataset
+    matches, _ = match_transactions(parsed_df, ref)
+    assert_recovers_house_typos(matches[matches.match_type == "token"], ref, parsed_df, truth, typos)
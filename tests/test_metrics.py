@@ -0,0 +1,82 @@
+from batches import run_batches
+from metrics import Metrics, metrics
+import json
+import pytest
+import time
+
+
+def test_counters_and_timers_by_label():
+    m = Metrics()
+    m.inc("rows_in_total", 10, stage="parse")
+    m.inc("rows_in_total", 5, stage="parse")
+    m.inc("rows_in_total", 7, stage="match")
+    m.observe_time("batch_seconds", 0.5, stage="parse")
+    m.observe_time("batch_seconds", 1.5, stage="parse")
+    assert m.counters[("rows_in_total", (("stage", "parse"),))] == 15
+    assert m.counters[("rows_in_total", (("stage", "match"),))] == 7
+    assert m.timers[("batch_seconds", (("stage", "parse"),))] == [2, 2.0, 1.5]
+
+
+def test_histogram_buckets_and_prometheus_cumulative():
+    m = Metrics()
+    m.observe("block_size", 1, matcher="fuzzy")
+    m.observe("block_size", 7, count=3, matcher="fuzzy")
+    m.observe("block_size", 5000, matcher="fuzzy")
+    histogram = m.histograms[("block_size", (("matcher", "fuzzy"),))]
+    assert histogram["count"] == 5
+    assert histogram["counts"][0] == 1 and histogram["counts"][3] == 3 and histogram["counts"][-1] == 1
+    text = m.to_prometheus()
+    assert 'block_size_bucket{matcher="fuzzy",le="10"} 4' in text
+    assert 'block_size_bucket{matcher="fuzzy",le="+Inf"} 5' in text
+    assert "# TYPE block_size histogram" in text
+
+
+def test_merge_adds_worker_state():
+    parent, worker = Metrics(), Metrics()
+    parent.inc("rows_in_total", 1, stage="match")
+    worker.inc("rows_in_total", 2, stage="match")
+    worker.observe_time("matcher_seconds", 3.0, matcher="fuzzy")
+    parent.merge(worker.state())
+    assert parent.counters[("rows_in_total", (("stage", "match"),))] == 3
+    assert parent.timers[("matcher_seconds", (("matcher", "fuzzy"),))] == [1, 3.0, 3.0]
+
+
+def test_json_round_trip(tmp_path):
+    m = Metrics()
+    m.inc("parse_failures_total", kind="normalization")
+    path = m.write(str(tmp_path / "metrics.json"), format="json")
+    with open(path) as f:
+        assert json.load(f)["counters"] == [{"name": "parse_failures_total", "labels": {"kind": "normalization"}, "value": 1}]
+
+
+def test_phase_shares_of_fake_stages():
+    m = Metrics()
+    m.observe_time("phase_seconds", 1.0, stage="parse", phase="fetch")
+    m.observe_time("phase_seconds", 2.0, stage="parse", phase="compute")
+    m.observe_time("phase_seconds", 4.0, stage="match", phase="compute")
+    m.observe_time("phase_seconds", 1.0, stage="match", phase="write")
+    m.observe_time("stage_seconds", 100.0, stage="match")
+    assert m.phase_shares() == pytest.approx({"fetch": 0.125, "compute": 0.75, "write": 0.125})
+
+
+@pytest.mark.parametrize("pipelined", [False, True])
+def test_run_batches_records_every_batch(pipelined):
+    metrics.reset()
+    written = []
+
+    def compute(batch):
+        time.sleep(0.01)
+        return batch * 2
+
+    run_batches(iter(range(5)), compute, written.append, "fake", pipelined=pipelined)
+    assert written == [0, 2, 4, 6, 8]
+    count, seconds, _ = metrics.timers[("batch_seconds", (("stage", "fake"),))]
+    assert count == 5 and seconds >= 0.04
+
+
+def test_run_batches_raises_a_failed_stage():
+    def write(result):
+        raise RuntimeError("disk full")
+
+    with pytest.raises(RuntimeError, match="disk full"):
+        run_batches(iter(range(100)), lambda batch: batch, write, "fake", pipelined=True)
@@ -0,0 +1,44 @@
+from concurrent.futures import ProcessPoolExecutor
+from parse import chunk_records, parse_all, parse_batch, record_parse_metrics
+from parse_cache import ParseCache
+from synthetic import generate_addresses, generate_transactions
+import logging
+
+
+def test_chunks_cover_every_worker():
+    records = list(range(1000))
+    chunks = chunk_records(records, 250, 16)
+    assert len(chunks) >= 16
+    assert [record for chunk in chunks for record in chunk] == records
+
+
+def test_chunks_keep_chunk_size_cap():
+    chunks = chunk_records(list(range(10000)), 250, 4)
+    assert max(len(chunk) for chunk in chunks) == 250
+
+
+def test_chunks_of_small_batch():
+    assert chunk_records([1, 2], 250, 8) == [[1], [2]]
+    assert chunk_records([], 250, 8) == []
+
+
+def test_pool_parses_like_in_process():
+    raw_df = generate_transactions(generate_addresses(200), 300)
+    records = raw_df.to_dict("records")
+    expected = parse_all(records, fast=False)
+    with ProcessPoolExecutor(max_workers=2) as pool:
+        parsed_rows, unmatched_records = parse_all(records, pool, 2, chunk_size=250, fast=False)
+    assert parsed_rows == expected[0]
+    assert [r["transaction_id"] for r in unmatched_records] == [r["transaction_id"] for r in expected[1]]
+
+
+def test_each_batch_logs_its_cache_hits(caplog):
+    raw_df = generate_transactions(generate_addresses(50), 100, duplicate_rate=0.5)
+    cache = ParseCache(path=None)
+    with caplog.at_level(logging.INFO, logger="parse"):
+        for batch in (raw_df, raw_df):
+            parsed_rows, unmatched_records = parse_batch(batch, cache=cache)
+            record_parse_metrics(len(batch), parsed_rows, unmatched_records, cache)
+    lines = [record.getMessage() for record in caplog.records if record.getMessage().startswith("Parse cache")]
+    assert len(lines) == 2
+    assert lines[1] == "Parse cache: 100 hits, 0 misses"
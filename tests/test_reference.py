@@ -0,0 +1,57 @@
+from reference import GridIndex, ReferenceIndex, METERS_PER_DEGREE_LAT, METERS_PER_DEGREE_LON
+from schema import addresses
+from sqlalchemy import create_engine, insert, select
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine("sqlite://")
+    addresses.create(engine)
+    with engine.begin() as conn:
+        conn.execute(
+            insert(addresses),
+            [
+                {"id": 1, "house": "123", "street": "MAIN", "strtype": "ST", "city": "BROOKLYN", "state": "NY", "zip": "11211"},
+                {"id": 2, "house": "9", "street": "KNIGHT", "strtype": "AVE", "city": "BROOKLYN", "state": "NY", "zip": "11211"},
+            ],
+        )
+    return engine
+
+
+def test_load_stores_missing_metaphone_codes(engine):
+    ref = ReferenceIndex.load(engine)
+    assert len(ref) == 2
+    with engine.connect() as conn:
+        codes = dict(conn.execute(select(addresses.c.id, addresses.c.street_metaphone)).all())
+    assert codes[1] and codes[2]
+    assert list(ref.phonetic_positions("9", [codes[2]])) == [1]
+
+
+def test_load_reads_stored_codes(engine, monkeypatch):
+    ReferenceIndex.load(engine)
+    monkeypatch.setattr("reference.phonetic_keys", lambda street: pytest.fail("codes were recomputed"))
+    assert len(ReferenceIndex.load(engine)) == 2
+
+
+def test_grid_index_finds_the_points_within_radius():
+    rng = np.random.default_rng(0)
+    latitudes = 40.70 + rng.random(5000) * 0.02
+    longitudes = -73.96 + rng.random(5000) * 0.02
+    latitudes[::50] = np.nan
+    grid = GridIndex(latitudes, longitudes, 50)
+    for latitude, longitude in zip(40.70 + rng.random(200) * 0.02, -73.96 + rng.random(200) * 0.02):
+        dy = (latitudes - latitude) * METERS_PER_DEGREE_LAT
+        dx = (longitudes - longitude) * METERS_PER_DEGREE_LON * np.cos(np.radians(latitude))
+        distances = np.hypot(dx, dy)
+        # float32 storage moves points by under a meter
+        expected = set(np.flatnonzero(distances <= 49))
+        found = grid.near(latitude, longitude)
+        assert expected <= set(found) <= set(np.flatnonzero(distances <= 51))
+        assert np.all(np.diff(distances[found]) >= -1)
+
+
+def test_grid_index_empty_cell():
+    grid = GridIndex(np.array([40.7]), np.array([-73.9]), 50)
+    assert len(grid.near(41.7, -73.9)) == 0
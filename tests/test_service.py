@@ -0,0 +1,77 @@
+from http.client import HTTPConnection
+from http.server import ThreadingHTTPServer
+from normalize import STREET_TYPE_ABBR
+from service import MatchRequestHandler, MatchService
+from threading import Thread
+import json
+import numpy as np
+import pytest
+import time
+
+
+@pytest.fixture(scope="module")
+def server(reference):
+    MatchRequestHandler.service = MatchService(reference)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MatchRequestHandler)
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def post(server, path, body):
+    conn = HTTPConnection(*server.server_address)
+    conn.request("POST", path, body=body if isinstance(body, bytes) else json.dumps(body).encode("utf-8"))
+    response = conn.getresponse()
+    result = response.status, json.loads(response.read())
+    conn.close()
+    return result
+
+
+@pytest.mark.parametrize("body", [["123 Main St"], "123 Main St", 5, None])
+@pytest.mark.parametrize("path", ["/match", "/match/batch"])
+def test_non_object_body_is_rejected(server, path, body):
+    status, result = post(server, path, body)
+    assert status == 400
+    assert "error" in result
+
+
+def test_invalid_json_is_rejected(server):
+    assert post(server, "/match", b"{")[0] == 400
+
+
+def test_missing_address_is_rejected(server):
+    assert post(server, "/match", {"addresses": ["123 Main St"]})[0] == 400
+
+
+def test_match_finds_the_listed_address(server, synthetic_dataset):
+    addr_df = synthetic_dataset[0]
+    row = addr_df[addr_df.aptnbr.isna()].iloc[0]
+    street_type = {abbr: name for name, abbr in STREET_TYPE_ABBR.items()}[row.strtype]
+    address = f"{row.house} {row.street} {street_type}, Brooklyn NY {row.zip}"
+    status, result = post(server, "/match", {"address": address})
+    assert status == 200
+    assert [(m["address_id"], m["match_type"]) for m in result["matches"]] == [(row.id, "exact")]
+
+
+def test_batch_limit(server):
+    status, _ = post(server, "/match/batch", {"addresses": ["1 A St, Brooklyn NY 11211"] * 1000})
+    assert status == 413
+
+
+def test_match_latency(server, synthetic_dataset):
+    raw_df = synthetic_dataset[1].head(500)
+    addresses = (raw_df.address_line_1 + ", " + raw_df.city + " " + raw_df.state + " " + raw_df.zip_code).tolist()
+    conn = HTTPConnection(*server.server_address)
+    elapsed = []
+    for address in addresses:
+        start = time.perf_counter()
+        conn.request("POST", "/match", body=json.dumps({"address": address}).encode("utf-8"))
+        response = conn.getresponse()
+        response.read()
+        elapsed.append(time.perf_counter() - start)
+        assert response.status == 200
+    conn.close()
+    # generous bound: a regression to a scan over the reference costs far more than this
+    assert np.percentile(elapsed, 99) < 0.05
@@ -0,0 +1,52 @@
+from match import record_tokens
+from reference import address_tokens, token_fields, TokenIndex
+import numpy as np
+import pytest
+
+
+def brute_force_scores(index, rows_tokens, tokens):
+    """idf-weighted overlap of every row with tokens; rows sharing no rare term score -inf."""
+    query = {token for token in tokens if token in index.vocabulary}
+    counts = {token: index.bounds[index.vocabulary[token] + 1] - index.bounds[index.vocabulary[token]] for token in query}
+    scores = np.full(len(rows_tokens), -np.inf)
+    for row, row_tokens in enumerate(rows_tokens):
+        shared = query & set(row_tokens)
+        if any(counts[token] <= index.max_postings for token in shared):
+            scores[row] = sum(index.idf[index.vocabulary[token]] for token in shared)
+    return scores
+
+
+@pytest.mark.parametrize("max_postings", [20, 1000])
+def test_top_k_matches_brute_force(reference, parsed_transactions, max_postings):
+    df = reference.df
+    houses = df.house.to_numpy(dtype=object)
+    zips = df.zip.to_numpy(dtype=object)
+    index = TokenIndex(token_fields(houses, reference.street_keys, reference.units, zips), max_postings)
+    rows_tokens = [
+        address_tokens(house, street, unit, zip_code)
+        for house, street, unit, zip_code in zip(houses, reference.street_keys, reference.units, zips)
+    ]
+    for txn in parsed_transactions.sample(100, random_state=1).itertuples(index=False):
+        tokens, _ = record_tokens(txn.street_number, txn.street_name, txn.street_type, txn.unit_identifier, txn.zip)
+        found = index.top_k(tokens, 10)
+        scores = brute_force_scores(index, rows_tokens, tokens)
+        candidates = np.flatnonzero(np.isfinite(scores))
+        expected = np.sort(scores[candidates])[::-1][:10]
+        assert len(found) == len(expected)
+        np.testing.assert_allclose(scores[found], expected)
+
+
+def test_top_k_breaks_ties_in_reference_order():
+    fields = token_fields(
+        np.array(["1", "1", "1"], dtype=object),
+        np.array(["MAIN ST", "MAIN ST", "MAIN ST"], dtype=object),
+        np.array([None, None, None], dtype=object),
+        np.array(["11211", "11211", "11211"], dtype=object),
+    )
+    index = TokenIndex(fields, 1000)
+    assert list(index.top_k(address_tokens("1", "MAIN ST", None, "11211"), 2)) == [0, 1]
+
+
+def test_top_k_without_known_terms():
+    index = TokenIndex(token_fields(*(np.array([value], dtype=object) for value in ("1", "MAIN ST", None, "11211"))), 1000)
+    assert len(index.top_k(["street:NOWHERE"], 5)) == 0
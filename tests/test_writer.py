@@ -0,0 +1,144 @@
+from ledger import CHECKPOINT_SQL
+from writer import BufferedWriter
+import ingest
+import pandas as pd
+import pytest
+
+
+class FakeConnection:
+    """Raw DB-API connection that records COPYs, statements and transaction ends as events."""
+
+    def __init__(self, events, fail_on=None):
+        self.events = events
+        self.fail_on = fail_on
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def copy_expert(self, sql, buffer):
+        table_name = sql.split()[1]
+        if table_name == self.fail_on:
+            raise RuntimeError(f"COPY into {table_name} failed")
+        self.events.append(("copy", table_name, len(buffer.read().splitlines())))
+
+    def execute(self, sql, params=None):
+        assert sql == CHECKPOINT_SQL
+        self.events.append(("checkpoint", params["last_key"], params["rows_in"], params["rows_out"]))
+
+    def commit(self):
+        self.events.append(("commit",))
+
+    def rollback(self):
+        self.events.append(("rollback",))
+
+    def close(self):
+        pass
+
+
+class FakeEngine:
+    def __init__(self, fail_on=None):
+        self.events = []
+        self.fail_on = fail_on
+
+    def raw_connection(self):
+        return FakeConnection(self.events, self.fail_on)
+
+
+def matches(*transaction_ids):
+    return pd.DataFrame({
+        "transaction_id": list(transaction_ids),
+        "address_id": [1] * len(transaction_ids),
+        "match_type": ["exact"] * len(transaction_ids),
+        "confidence_score": [1.0] * len(transaction_ids),
+    })
+
+
+def unmatched(*transaction_ids):
+    return pd.DataFrame({"transaction_id": list(transaction_ids), "reason": ["no match"] * len(transaction_ids)})
+
+
+def test_writer_flushes_only_at_checkpoints():
+    engine = FakeEngine()
+    writer = BufferedWriter(engine=engine, max_rows=2, run_id="run", ledger_stage="match")
+    writer.add("match_results", matches("a", "b"))
+    writer.add("unmatched_report", unmatched("c"))
+    assert engine.events == []  # past max_rows, but the batch is not checkpointed yet
+    writer.checkpoint("c", rows_in=3)
+    assert engine.events == [
+        ("copy", "unmatched_report", 1),  # tables go in foreign key order, not in the order they were added
+        ("copy", "match_results", 2),
+        ("checkpoint", "c", 3, 3),
+        ("commit",),
+    ]
+
+
+def test_writer_carries_checkpoints_until_the_next_flush():
+    engine = FakeEngine()
+    writer = BufferedWriter(engine=engine, max_rows=3, run_id="run", ledger_stage="match")
+    writer.add("match_results", matches("a"))
+    writer.checkpoint("a", rows_in=1)
+    writer.add("match_results", matches("b"))
+    writer.checkpoint("b", rows_in=2)  # a transaction without any results still counts as input
+    assert engine.events == []
+    writer.close()
+    assert engine.events == [("copy", "match_results", 2), ("checkpoint", "b", 3, 2), ("commit",)]
+
+
+def test_writer_checkpoints_a_batch_without_results():
+    engine = FakeEngine()
+    writer = BufferedWriter(engine=engine, run_id="run", ledger_stage="match")
+    writer.checkpoint("z", rows_in=5)
+    writer.close()
+    assert engine.events == [("checkpoint", "z", 5, 0), ("commit",)]
+
+
+def test_failed_flush_rolls_back_the_checkpoint():
+    engine = FakeEngine(fail_on="match_results")
+    writer = BufferedWriter(engine=engine, max_rows=1, run_id="run", ledger_stage="match")
+    writer.add("match_results", matches("a"))
+    writer.add("unmatched_report", unmatched("b"))
+    with pytest.raises(RuntimeError):
+        writer.checkpoint("b", rows_in=2)
+    assert engine.events == [("copy", "unmatched_report", 1), ("rollback",)]
+
+
+def test_writer_drops_the_buffer_when_the_stage_fails():
+    engine = FakeEngine()
+    with pytest.raises(ValueError):
+        with BufferedWriter(engine=engine, run_id="run", ledger_stage="match") as writer:
+            writer.add("match_results", matches("a"))
+            writer.checkpoint("a", rows_in=1)
+            raise ValueError("match failed")
+    assert engine.events == []
+
+
+@pytest.fixture
+def failing_ingest(monkeypatch):
+    """load_data with an in-memory ledger whose transactions load fails."""
+    finished = []
+    monkeypatch.setattr(ingest, "begin_stage", lambda run_id, stage: {"status": "running"})
+    monkeypatch.setattr(ingest, "finish_stage", lambda run_id, stage, **counts: finished.append(stage))
+    monkeypatch.setattr(ingest, "ingest_address", lambda csv_path, mode: 10)
+
+    def ingest_transactions(csv_path, mode):
+        raise OSError("transactions file is missing")
+
+    monkeypatch.setattr(ingest, "ingest_transactions", ingest_transactions)
+    return finished
+
+
+def test_load_data_raises_within_a_run(failing_ingest):
+    with pytest.raises(OSError):
+        ingest.load_data(run_id="run")
+    assert failing_ingest == ["ingest.addresses"]
+
+
+def test_load_data_only_logs_outside_a_run(failing_ingest):
+    ingest.load_data()
+    assert failing_ingest == []